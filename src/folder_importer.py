@@ -0,0 +1,209 @@
+# folder_importer.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fnmatch
+from collections import deque
+from gi.repository import Gio, GLib
+
+from .misc import get_natural_sort_key
+
+# Only what is needed to tell pictures apart: the content type is guessed
+# from the name, so the files are never opened
+IMPORT_ATTRIBUTES = 'standard::name,standard::type,standard::is-symlink,' + \
+                                                'standard::fast-content-type'
+
+# Number of files asked to the enumerator at once
+FILES_PER_BATCH = 256
+
+# Number of folders read at the same time by a recursive import
+MAX_PARALLEL_FOLDERS = 4
+
+# Extensions of pictures, which don't need any further check
+PICTURE_EXTENSIONS = {'jpg', 'jpeg', 'jpe', 'png', 'gif', 'bmp', 'tif', \
+                  'tiff', 'webp', 'svg', 'svgz', 'tga', 'ico', 'avif', 'heic'}
+
+# Content type guessed for files whose name tells nothing (no extension, or
+# an unknown one), so their content has to be sniffed
+AMBIGUOUS_TYPE = 'application/octet-stream'
+
+def matches_patterns(name, patterns):
+	for pattern in patterns:
+		if fnmatch.fnmatch(name, pattern):
+			return True
+	return False
+
+def is_picture_name(name, content_type):
+	"""Tell if a file is a picture from its name, or from the `content_type`
+	guessed from its name."""
+	if '.' in name:
+		extension = name.rpartition('.')[2].lower()
+		if extension in PICTURE_EXTENSIONS:
+			return True
+	return content_type is not None and content_type.startswith('image/')
+
+class DWEFolderImporter():
+	"""Find the pictures of a folder using the asynchronous API of Gio, one
+	batch of files at a time, so the main loop is never blocked, even by a
+	network mount. `on_pictures` is called with the paths of each batch of
+	pictures, and `on_done` is called once, with the first error (or None),
+	when everything has been read or the import has been cancelled.
+
+	If `is_recursive`, subfolders are read too, several at the same time.
+	Files are recognized by their extension, and only those whose name is
+	ambiguous are opened to sniff their type. Names can be filtered with
+	lists of glob patterns: `include` for files, `exclude` for files and
+	folders."""
+
+	def __init__(self, gfile, on_pictures, on_done, is_recursive=False, \
+	                                             include=None, exclude=None):
+		self._gfile = gfile
+		self._on_pictures = on_pictures
+		self._on_done = on_done
+		self._is_recursive = is_recursive
+		self._include = include or []
+		self._exclude = exclude or []
+		self._cancellable = Gio.Cancellable()
+		self._folders = deque()
+		self._nb_enumerating = 0
+		self._nb_sniffing = 0
+		self._error = None
+		self._is_done = False
+		self.nb_found = 0
+
+	def start(self):
+		self._folders.append(self._gfile)
+		self._start_next_folders()
+
+	def cancel(self):
+		self._cancellable.cancel()
+
+	def is_cancelled(self):
+		return self._cancellable.is_cancelled()
+
+	############################################################################
+
+	def _start_next_folders(self):
+		while len(self._folders) > 0 \
+		                        and self._nb_enumerating < MAX_PARALLEL_FOLDERS:
+			folder = self._folders.popleft()
+			self._nb_enumerating += 1
+			folder.enumerate_children_async(IMPORT_ATTRIBUTES, \
+			                  Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_LOW, \
+			                  self._cancellable, self._on_enumerator_ready, folder)
+		if self._nb_enumerating == 0 and self._nb_sniffing == 0 \
+		                                                  and not self._is_done:
+			self._is_done = True
+			self._on_done(self._error)
+
+	def _end_task(self, error=None, is_sniffing=False):
+		if error is not None and self._error is None and not error.matches( \
+		                       Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+			self._error = error
+		if is_sniffing:
+			self._nb_sniffing -= 1
+		else:
+			self._nb_enumerating -= 1
+		if self.is_cancelled():
+			self._folders.clear()
+		self._start_next_folders()
+
+	def _on_enumerator_ready(self, folder, result, *args):
+		try:
+			enumerator = folder.enumerate_children_finish(result)
+		except GLib.Error as err:
+			self._end_task(err)
+			return
+		self._next_batch(enumerator, folder)
+
+	def _next_batch(self, enumerator, folder):
+		enumerator.next_files_async(FILES_PER_BATCH, GLib.PRIORITY_LOW, \
+		                       self._cancellable, self._on_batch_ready, folder)
+
+	def _on_batch_ready(self, enumerator, result, folder):
+		try:
+			infos = enumerator.next_files_finish(result)
+		except GLib.Error as err:
+			enumerator.close_async(GLib.PRIORITY_LOW, None, None, None)
+			self._end_task(err)
+			return
+		if len(infos) == 0 or self.is_cancelled():
+			enumerator.close_async(GLib.PRIORITY_LOW, None, None, None)
+			self._end_task()
+			return
+
+		paths = []
+		subfolders = []
+		for info in infos:
+			name = info.get_name()
+			if matches_patterns(name, self._exclude):
+				continue
+			file_type = info.get_file_type()
+			if file_type == Gio.FileType.DIRECTORY:
+				if self._is_recursive and not name.startswith('.') \
+				                                     and not info.get_is_symlink():
+					subfolders.append(folder.get_child(name))
+			elif file_type != Gio.FileType.REGULAR:
+				continue
+			elif self._include and not matches_patterns(name, self._include):
+				continue
+			elif self._is_picture(info):
+				paths.append(folder.get_child(name).get_path())
+			elif self._is_ambiguous(info):
+				self._sniff(folder.get_child(name))
+
+		subfolders.sort(key=lambda f: get_natural_sort_key(f.get_basename()))
+		self._folders.extend(subfolders)
+		self._add_pictures(paths)
+		self._next_batch(enumerator, folder)
+		self._start_next_folders()
+
+	def _add_pictures(self, paths):
+		if len(paths) > 0 and not self.is_cancelled():
+			self.nb_found += len(paths)
+			self._on_pictures(paths)
+
+	############################################################################
+
+	def _is_picture(self, info):
+		content_type = info.get_attribute_string('standard::fast-content-type')
+		return is_picture_name(info.get_name(), content_type)
+
+	def _is_ambiguous(self, info):
+		content_type = info.get_attribute_string('standard::fast-content-type')
+		return content_type is None or content_type == AMBIGUOUS_TYPE
+
+	def _sniff(self, gfile):
+		"""Read the beginning of the file to know its actual type."""
+		self._nb_sniffing += 1
+		gfile.query_info_async('standard::content-type', \
+		                      Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_LOW, \
+		                      self._cancellable, self._on_sniffed, None)
+
+	def _on_sniffed(self, gfile, result, *args):
+		try:
+			info = gfile.query_info_finish(result)
+		except GLib.Error as err:
+			self._end_task(err, True)
+			return
+		content_type = info.get_content_type()
+		if content_type is not None and content_type.startswith('image/'):
+			self._add_pictures([gfile.get_path()])
+		self._end_task(None, True)
+
+	############################################################################
+################################################################################
+
@@ -0,0 +1,187 @@
+# folder_watcher.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import Gio, GLib
+
+from .folder_importer import is_picture_name, matches_patterns
+from .misc import get_natural_sort_key
+
+# Delay (in milliseconds) during which the events of the folder are
+# accumulated before being applied to the model
+SYNC_DELAY = 500
+
+class DWEFolderWatcher():
+	"""Keep the pictures of a data model in sync with a folder (not its
+	subfolders): new pictures are added at the end, deleted pictures are
+	removed, and renamed pictures keep their durations and their position.
+
+	Events are accumulated for SYNC_DELAY, and only the final state of each
+	file is applied, as one transaction: a picture created then deleted in
+	the meantime costs nothing. The folder is never enumerated again, and the
+	pictures of the model are indexed by path as the model changes, so the
+	model isn't read entirely either. The callback is called after each
+	transaction."""
+
+	def __init__(self, gfile, data_model, include, exclude, callback):
+		self._gfile = gfile
+		self._data_model = data_model
+		self._include = include
+		self._exclude = exclude
+		self._callback = callback
+		self._exists = {} # whether the file exists, by path
+		self._renamed = {} # original path by new path
+		self._timeout_id = None
+		self._pic_paths = {} # path by pic_id
+		self._path_ids = {} # set of pic_ids by path
+		self._monitor = gfile.monitor_directory( \
+		                                   Gio.FileMonitorFlags.WATCH_MOVES, None)
+		self._monitor.connect('changed', self.on_folder_changed)
+		self._index_pictures()
+		data_model.add_observer(self.on_model_changed)
+
+	def get_name(self):
+		return self._gfile.get_basename()
+
+	def stop(self):
+		self._data_model.remove_observer(self.on_model_changed)
+		self._monitor.cancel()
+		if self._timeout_id is not None:
+			GLib.source_remove(self._timeout_id)
+			self._timeout_id = None
+
+	############################################################################
+
+	def on_model_changed(self, delta):
+		if delta.is_reset:
+			self._index_pictures()
+			return
+		for pic_id in delta.removed:
+			self._unindex(pic_id)
+		for pic_id, fields in delta.changed.items():
+			if 'path' in fields:
+				self._unindex(pic_id)
+				self._index(pic_id, self._data_model.get_picture(pic_id).path)
+		for pic_id in delta.added:
+			self._index(pic_id, self._data_model.get_picture(pic_id).path)
+
+	def _index_pictures(self):
+		self._pic_paths = {}
+		self._path_ids = {}
+		for pic in self._data_model.get_pictures():
+			self._index(pic.pic_id, pic.path)
+
+	def _index(self, pic_id, path):
+		self._pic_paths[pic_id] = path
+		self._path_ids.setdefault(path, set()).add(pic_id)
+
+	def _unindex(self, pic_id):
+		path = self._pic_paths.pop(pic_id, None)
+		if path is None:
+			return
+		pic_ids = self._path_ids[path]
+		pic_ids.discard(pic_id)
+		if len(pic_ids) == 0:
+			del self._path_ids[path]
+
+	############################################################################
+
+	def on_folder_changed(self, monitor, gfile, other_gfile, event):
+		path = gfile.get_path()
+		if event == Gio.FileMonitorEvent.CREATED \
+		                               or event == Gio.FileMonitorEvent.MOVED_IN:
+			self._set_exists(path, True)
+		elif event == Gio.FileMonitorEvent.DELETED \
+		                              or event == Gio.FileMonitorEvent.MOVED_OUT:
+			self._set_exists(path, False)
+		elif event == Gio.FileMonitorEvent.RENAMED:
+			new_path = other_gfile.get_path()
+			self._set_exists(new_path, False) # a replaced file is deleted
+			origin = self._renamed.pop(path, path)
+			self._exists.pop(path, None)
+			self._renamed[new_path] = origin
+		else:
+			return
+		if self._timeout_id is None:
+			self._timeout_id = GLib.timeout_add(SYNC_DELAY, \
+			                                            self._on_sync_timeout)
+
+	def _set_exists(self, path, exists):
+		origin = self._renamed.pop(path, None)
+		if origin is not None:
+			# The file renamed to `path` is replaced or deleted
+			self._exists[origin] = False
+		self._exists[path] = exists
+
+	def _accepts(self, path):
+		name = GLib.path_get_basename(path)
+		if matches_patterns(name, self._exclude):
+			return False
+		if self._include and not matches_patterns(name, self._include):
+			return False
+		content_type, is_uncertain = Gio.content_type_guess(name, None)
+		return is_picture_name(name, content_type)
+
+	############################################################################
+
+	def _on_sync_timeout(self):
+		self._timeout_id = None
+		exists = self._exists
+		renamed = self._renamed
+		self._exists = {}
+		self._renamed = {}
+
+		ids_by_path = self._path_ids
+		operations = []
+		new_paths = []
+		for new_path, origin in renamed.items():
+			if origin not in ids_by_path:
+				if self._accepts(new_path):
+					new_paths.append(new_path)
+			elif self._accepts(new_path):
+				for pic_id in ids_by_path[origin]:
+					operations.append({
+						'type': 'edit',
+						'pic_id': pic_id,
+						'path': new_path,
+					})
+			else:
+				exists[origin] = False
+		for path, does_exist in exists.items():
+			if does_exist and path not in ids_by_path and self._accepts(path):
+				new_paths.append(path)
+			elif not does_exist and path in ids_by_path:
+				for pic_id in ids_by_path[path]:
+					operations.append({'type': 'delete', 'pic_id': pic_id})
+		new_paths.sort(key=get_natural_sort_key)
+		for path in new_paths:
+			operations.append({
+				'type': 'add',
+				'path': path,
+				'static': 10,
+				'transition': 0,
+			})
+
+		if len(operations) > 0:
+			with self._data_model.transaction():
+				for operation in operations:
+					self._data_model.do_operation(operation)
+			self._callback()
+		return False
+
+	############################################################################
+################################################################################
+
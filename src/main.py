@@ -21,6 +21,9 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gio, GLib, Gdk
 
 from .window import DWEWindow
+from .pixbuf_cache import DWEPixbufCache
+from .picture_info import DWEPictureInfoService
+from .thumbnail_loader import DWEThumbnailLoader
 
 APP_ID = 'com.github.maoschanz.DynamicWallpaperEditor'
 UI_PATH = '/com/github/maoschanz/DynamicWallpaperEditor/ui/'
@@ -46,6 +49,7 @@ class Application(Gtk.Application):
 		self.connect('startup', self.on_startup)
 		self.connect('activate', self.on_activate)
 		self.connect('command-line', self.on_cli)
+		self.connect('shutdown', self.on_shutdown)
 		self.register(None)
 		self._version = version
 		self.runs_in_sandbox = False
@@ -58,6 +62,26 @@ class Application(Gtk.Application):
 	def on_startup(self, *args):
 		self.set_gsettings_values()
 		self.build_app_actions()
+		self.build_thumbnail_loader()
+
+	def build_thumbnail_loader(self):
+		"""The pixbuf cache and the thumbnail loader are shared by all windows,
+		so a picture is decoded once even if it's displayed several times."""
+		settings = Gio.Settings.new(APP_ID)
+		max_bytes = settings.get_int('thumbnails-cache-size')
+		self.pixbuf_cache = DWEPixbufCache(max_bytes)
+		settings.connect('changed::thumbnails-cache-size', \
+		                                      self.on_thumbnails_cache_changed)
+		self._settings = settings
+		self.thumbnail_loader = DWEThumbnailLoader(self.pixbuf_cache)
+		self.picture_info_service = DWEPictureInfoService(self.thumbnail_loader)
+
+	def on_thumbnails_cache_changed(self, settings, key):
+		self.pixbuf_cache.set_max_bytes(settings.get_int(key))
+
+	def on_shutdown(self, *args):
+		self.thumbnail_loader.shutdown()
+		self.pixbuf_cache.clear()
 
 	def on_activate(self, *args):
 		"""I don't know if this is ever called from the 'activate' signal, but
@@ -94,26 +118,29 @@ class Application(Gtk.Application):
 		else:
 			# If file(s) given as argument(s)
 			for path in arguments:
-				f = self.get_valid_file(args[1], path)
-				if f is not None:
-					self.open_window_with_content(f)
+				self.open_valid_file(args[1], path)
 		# I don't even know if i should return something
 		return 0
 
-	def get_valid_file(self, app, path):
+	def open_valid_file(self, command_line, path):
+		"""Open a window for `path` if it's an XML file. The type of the file
+		is queried asynchronously, so the windows of the other files don't
+		have to wait, and the application is held in the meantime."""
 		if path == CURRENT_BINARY_PATH:
 			# when it's CURRENT_BINARY_PATH, the situation is normal (no error)
 			# and nothing to open.
-			return None
-
+			return
+		f = command_line.create_file_for_arg(path)
+		self.hold()
+		f.query_info_async('standard::content-type', \
+		                   Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_DEFAULT, \
+		                   None, self._on_file_queried, path)
+
+	def _on_file_queried(self, f, result, path):
 		try:
-			f = app.create_file_for_arg(path)
-			info = f.query_info('standard::*', \
-			               Gio.FileQueryInfoFlags.NONE, None).get_content_type()
+			info = f.query_info_finish(result).get_content_type()
 			if ('text/xml' in info) or ('application/xml' in info):
-				return f
-			else:
-				return None
+				self.open_window_with_content(f)
 		except Exception as exception:
 			err = _("Error opening this file.")
 			if self.runs_in_sandbox:
@@ -123,7 +150,8 @@ class Application(Gtk.Application):
 				print(err % command)
 			else:
 				print(err + "\n" + str(exception))
-			return None
+		finally:
+			self.release()
 
 	############################################################################
 
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import gi, math
+import gi, math, re
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
 from gettext import ngettext
@@ -64,6 +64,26 @@ def time_to_string(total_time):
 	message += str(ngettext("%s second", "%s seconds", seconds) % seconds)
 	return message
 
+def add_duration(start_time, duration):
+	"""Returns the [hours, minutes, seconds] time of the day reached `duration`
+	seconds after `start_time`."""
+	if duration == 0:
+		return start_time
+	hours, mins, seconds = get_hms(duration)
+	total = ((start_time[0] + hours) * 60 + start_time[1] + mins) * 60 \
+	                                                 + start_time[2] + seconds
+	h, m, s = get_hms(total)
+	return [h % 24, m, s]
+
+def get_natural_sort_key(text):
+	"""Key to sort strings in a natural order, where numbers are compared by
+	their value: "frame9" comes before "frame10"."""
+	parts = re.split(r'(\d+)', text.casefold())
+	# Digits are always at odd positions, so ints are never compared to strs
+	for i in range(1, len(parts), 2):
+		parts[i] = int(parts[i])
+	return parts
+
 def get_hms(total_time):
 	hours = math.floor(total_time / 3600)
 	mins = math.floor((total_time % 3600) / 60)
@@ -0,0 +1,228 @@
+# path_checker.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from gi.repository import Gio, GLib
+
+from .thumbnail_loader import DWETask, QUEUE_BACKGROUND
+
+PATH_OK = 'ok'
+PATH_MISSING = 'missing'
+PATH_UNREADABLE = 'unreadable'
+# The file can't be seen from the Flatpak sandbox, but it may exist
+PATH_NOT_VISIBLE = 'not-visible'
+
+# Delay (in milliseconds) before checking again the paths concerned by
+# file monitor events, which usually come in bursts
+RECHECK_DELAY = 300
+
+def is_path_missing(status):
+	return status == PATH_MISSING or status == PATH_UNREADABLE
+
+class DWEPathChecker():
+	"""Know whether the file of each picture of a data model exists and can be
+	read. New paths are checked together, on the background thread of the
+	thumbnail loader, with a simple `stat`: no picture is decoded for that.
+	The parent directories are watched, so the status of a picture changes
+	when its file appears or disappears. The callback is called with the set
+	of pic_ids whose status changed.
+
+	If `is_sandboxed`, only the home folder and the files given by the
+	document portal are visible, so other files which seem to be missing
+	(such as the wallpapers of the system) aren't counted as missing."""
+
+	def __init__(self, loader, callback, is_sandboxed=False):
+		self._loader = loader
+		self._callback = callback
+		self._visible_dirs = None
+		if is_sandboxed:
+			self._visible_dirs = (GLib.get_home_dir() + '/', '/run/user/')
+		self._statuses = {} # statuses by path, None if not checked yet
+		self._pic_paths = {} # path by pic_id
+		self._path_pics = {} # set of pic_ids by path
+		self._monitors = {} # (monitor, handler id) by directory
+		self._dir_paths = {} # set of watched paths by directory
+		self._nb_missing = 0 # pictures whose file is missing or unreadable
+		self._to_check = set()
+		self._task = None
+		self._timeout_id = None
+
+	def update(self, delta, data_model):
+		"""Check the pictures added or changed according to `delta`, a
+		`DWEModelDelta`."""
+		if delta.is_reset:
+			# The paths which are still used keep their status and monitors
+			new_paths = {}
+			for pic in data_model.get_pictures():
+				new_paths[pic.pic_id] = pic.path
+			for pic_id, path in list(self._pic_paths.items()):
+				if new_paths.get(pic_id, None) != path:
+					self._forget(pic_id)
+			for pic_id, path in new_paths.items():
+				if pic_id not in self._pic_paths:
+					self._watch(pic_id, path)
+		else:
+			for pic_id in delta.removed:
+				self._forget(pic_id)
+			for pic_id, fields in delta.changed.items():
+				if 'path' in fields:
+					self._forget(pic_id)
+					self._watch(pic_id, data_model.get_picture(pic_id).path)
+			for pic_id in delta.added:
+				self._watch(pic_id, data_model.get_picture(pic_id).path)
+		self._check_queued_paths()
+
+	def clear(self):
+		for pic_id in list(self._pic_paths.keys()):
+			self._forget(pic_id)
+		if self._task is not None:
+			self._task.cancel()
+			self._task = None
+		if self._timeout_id is not None:
+			GLib.source_remove(self._timeout_id)
+			self._timeout_id = None
+
+	def get_status(self, pic_id):
+		path = self._pic_paths.get(pic_id, None)
+		return self._statuses.get(path, None)
+
+	def get_nb_missing(self):
+		return self._nb_missing
+
+	############################################################################
+
+	def _watch(self, pic_id, path):
+		self._pic_paths[pic_id] = path
+		if path in self._path_pics:
+			self._path_pics[path].add(pic_id)
+			if is_path_missing(self._statuses[path]):
+				self._nb_missing += 1
+			return
+		self._path_pics[path] = {pic_id}
+		self._statuses[path] = None
+		self._to_check.add(path)
+		directory = os.path.dirname(path)
+		if directory not in self._dir_paths:
+			self._dir_paths[directory] = set()
+			self._monitor_directory(directory)
+		self._dir_paths[directory].add(path)
+
+	def _forget(self, pic_id):
+		path = self._pic_paths.pop(pic_id)
+		pic_ids = self._path_pics[path]
+		pic_ids.discard(pic_id)
+		if is_path_missing(self._statuses[path]):
+			self._nb_missing -= 1
+		if len(pic_ids) > 0:
+			return
+		del self._path_pics[path]
+		del self._statuses[path]
+		self._to_check.discard(path)
+		directory = os.path.dirname(path)
+		self._dir_paths[directory].discard(path)
+		if len(self._dir_paths[directory]) == 0:
+			del self._dir_paths[directory]
+			monitor, handler_id = self._monitors.pop(directory, (None, None))
+			if monitor is not None:
+				monitor.disconnect(handler_id)
+				monitor.cancel()
+
+	def _monitor_directory(self, directory):
+		try:
+			gfile = Gio.File.new_for_path(directory)
+			monitor = gfile.monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, \
+			                                                              None)
+		except Exception:
+			# The directory may not exist (yet), its pictures are still
+			# checked, they just won't be updated live
+			return
+		handler_id = monitor.connect('changed', self.on_directory_changed, \
+		                                                             directory)
+		self._monitors[directory] = (monitor, handler_id)
+
+	def on_directory_changed(self, monitor, gfile, other_gfile, event, directory):
+		if event == Gio.FileMonitorEvent.CHANGES_DONE_HINT \
+		                              or event == Gio.FileMonitorEvent.CHANGED:
+			return # the content doesn't tell if the file exists
+		paths = self._dir_paths.get(directory, set())
+		if gfile.get_path() == directory:
+			self._to_check.update(paths) # the directory itself changed
+		for changed_file in (gfile, other_gfile):
+			if changed_file is not None and changed_file.get_path() in paths:
+				self._to_check.add(changed_file.get_path())
+		if len(self._to_check) > 0 and self._timeout_id is None:
+			self._timeout_id = GLib.timeout_add(RECHECK_DELAY, \
+			                                       self._on_recheck_timeout)
+
+	def _on_recheck_timeout(self):
+		self._timeout_id = None
+		self._check_queued_paths()
+		return False
+
+	def _check_queued_paths(self):
+		"""Check all the queued paths with one background task. Paths queued
+		while it runs are checked by the next one."""
+		if self._task is not None or len(self._to_check) == 0:
+			return
+		paths = list(self._to_check)
+		self._to_check = set()
+		self._task = DWETask(self._on_paths_checked)
+		self._loader.run_in_worker(self._task, lambda task: \
+		                      self._check_paths(paths, task), QUEUE_BACKGROUND)
+
+	def _check_paths(self, paths, task):
+		# Called on a worker thread
+		statuses = {}
+		for path in paths:
+			if task.is_cancelled():
+				break
+			if not os.path.isfile(path):
+				if self._is_visible(path):
+					statuses[path] = PATH_MISSING
+				else:
+					statuses[path] = PATH_NOT_VISIBLE
+			elif not os.access(path, os.R_OK):
+				statuses[path] = PATH_UNREADABLE
+			else:
+				statuses[path] = PATH_OK
+		return statuses
+
+	def _is_visible(self, path):
+		if self._visible_dirs is None:
+			return True
+		return path.startswith(self._visible_dirs)
+
+	def _on_paths_checked(self, statuses, error):
+		self._task = None
+		changed_ids = set()
+		for path, status in (statuses or {}).items():
+			if path not in self._statuses or self._statuses[path] == status:
+				continue # forgotten in the meantime, or nothing new
+			nb_pics = len(self._path_pics[path])
+			if is_path_missing(self._statuses[path]):
+				self._nb_missing -= nb_pics
+			if is_path_missing(status):
+				self._nb_missing += nb_pics
+			self._statuses[path] = status
+			changed_ids.update(self._path_pics[path])
+		self._check_queued_paths()
+		if len(changed_ids) > 0:
+			self._callback(changed_ids)
+
+	############################################################################
+################################################################################
+
@@ -0,0 +1,209 @@
+# picture_info.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import Counter
+from gi.repository import Gio, GdkPixbuf, GLib
+
+from .thumbnail_loader import DWETask, QUEUE_BACKGROUND
+
+class DWEPictureInfo():
+	"""What is known about a picture file without decoding it."""
+	__slots__ = ('format_name', 'width', 'height', 'file_size', 'mtime')
+
+	def __init__(self, format_name, width, height, file_size, mtime):
+		self.format_name = format_name
+		self.width = width
+		self.height = height
+		self.file_size = file_size
+		self.mtime = mtime
+
+	def get_resolution(self):
+		return (self.width, self.height)
+
+	def to_string(self):
+		return "{0} – {1}×{2} – {3}".format(self.format_name, self.width, \
+		                        self.height, GLib.format_size(self.file_size))
+
+	############################################################################
+################################################################################
+
+class DWEPictureInfoService():
+	"""Read the format and the dimensions of pictures from their headers only,
+	on the background thread of the thumbnail loader. Results are cached by
+	path for the whole application, and probed again if the mtime or the size
+	of the file changed."""
+
+	def __init__(self, loader):
+		self._loader = loader
+		self._lock = threading.Lock()
+		self._infos = {}
+
+	def request(self, path, callback):
+		"""`callback` will be called on the main loop with the info (or None)
+		and the error (or None)."""
+		task = DWETask(callback)
+		return self._loader.run_in_worker(task, \
+		               lambda task: self._probe(path, task), QUEUE_BACKGROUND)
+
+	def get_cached(self, path):
+		with self._lock:
+			return self._infos.get(path, None)
+
+	############################################################################
+
+	def _probe(self, path, task):
+		gfile = Gio.File.new_for_path(path)
+		file_info = gfile.query_info('time::modified,standard::size', \
+		                          Gio.FileQueryInfoFlags.NONE, task.cancellable)
+		mtime = file_info.get_attribute_uint64('time::modified')
+		file_size = file_info.get_size()
+		info = self.get_cached(path)
+		if info is not None and info.mtime == mtime \
+		                                         and info.file_size == file_size:
+			return info
+
+		pixbuf_format, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+		if pixbuf_format is None:
+			raise Exception(_("This file isn't a picture"))
+		info = DWEPictureInfo(pixbuf_format.get_name().upper(), width, \
+		                                             height, file_size, mtime)
+		with self._lock:
+			self._infos[path] = info
+		return info
+
+	############################################################################
+################################################################################
+
+class DWEResolutionChecker():
+	"""Know the info of every picture of a data model, in order to find the
+	pictures whose resolution isn't the most common one. The callback is
+	called (with the set of concerned pic_ids) when infos have been
+	received."""
+
+	def __init__(self, service, callback):
+		self._service = service
+		self._callback = callback
+		self._pic_paths = {} # path by pic_id
+		self._infos = {} # infos by pic_id
+		self._requests = {} # pending requests by pic_id
+		self._resolutions = Counter()
+		self._most_common = None
+		self._received = set()
+		self._idle_id = None
+
+	def update(self, delta, data_model):
+		"""Probe the pictures added or changed according to `delta`, a
+		`DWEModelDelta`."""
+		if delta.is_reset:
+			# The pictures whose path didn't change keep their info
+			new_pics = {}
+			for pic in data_model.get_pictures():
+				new_pics[pic.pic_id] = pic
+			for pic_id, path in list(self._pic_paths.items()):
+				pic = new_pics.get(pic_id, None)
+				if pic is None or pic.path != path:
+					self._forget(pic_id)
+			for pic_id, pic in new_pics.items():
+				if pic_id not in self._pic_paths:
+					self._probe(pic)
+			return
+		for pic_id in delta.removed:
+			self._forget(pic_id)
+		for pic_id, fields in delta.changed.items():
+			if 'path' in fields:
+				self._forget(pic_id)
+				self._probe(data_model.get_picture(pic_id))
+		for pic_id in delta.added:
+			self._probe(data_model.get_picture(pic_id))
+
+	def clear(self):
+		for pic_id in list(self._pic_paths.keys()):
+			self._forget(pic_id)
+		if self._idle_id is not None:
+			GLib.source_remove(self._idle_id)
+			self._idle_id = None
+
+	def get_info(self, pic_id):
+		return self._infos.get(pic_id, None)
+
+	def is_mismatched(self, pic_id):
+		info = self._infos.get(pic_id, None)
+		if info is None or self._most_common is None:
+			return False
+		return info.get_resolution() != self._most_common
+
+	def get_most_common(self):
+		return self._most_common
+
+	def get_nb_mismatched(self):
+		if self._most_common is None:
+			return 0
+		total = sum(self._resolutions.values())
+		return total - self._resolutions[self._most_common]
+
+	############################################################################
+
+	def _probe(self, pic):
+		pic_id = pic.pic_id
+		self._pic_paths[pic_id] = pic.path
+		self._requests[pic_id] = self._service.request(pic.path, \
+		                 lambda info, error: self._on_probed(pic_id, info))
+
+	def _forget(self, pic_id):
+		self._pic_paths.pop(pic_id, None)
+		request = self._requests.pop(pic_id, None)
+		if request is not None:
+			request.cancel()
+		info = self._infos.pop(pic_id, None)
+		if info is not None:
+			self._resolutions[info.get_resolution()] -= 1
+			self._received.add(pic_id)
+			self._queue_callback()
+
+	def _on_probed(self, pic_id, info):
+		self._requests.pop(pic_id, None)
+		if info is None:
+			return # not a picture, or missing file
+		self._infos[pic_id] = info
+		self._resolutions[info.get_resolution()] += 1
+		self._received.add(pic_id)
+		self._queue_callback()
+
+	def _queue_callback(self):
+		# Results arrive in batches, so the callback is called once per batch
+		if self._idle_id is None:
+			self._idle_id = GLib.idle_add(self._on_idle_callback)
+
+	def _on_idle_callback(self):
+		self._idle_id = None
+		previous = self._most_common
+		self._resolutions += Counter() # removes the null counts
+		if len(self._resolutions) == 0:
+			self._most_common = None
+		else:
+			self._most_common = self._resolutions.most_common(1)[0][0]
+		received = self._received
+		self._received = set()
+		if previous != self._most_common:
+			received = None # every picture may be concerned
+		self._callback(received)
+		return False
+
+	############################################################################
+################################################################################
+
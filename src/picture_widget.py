@@ -15,74 +15,71 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk, GdkPixbuf, Pango, Gdk, GLib
+from gi.repository import Gtk, Pango, Gdk, GLib
 import math
 
 from .misc import time_to_string
-from .misc import get_hms
+from .misc import add_duration
+from .path_checker import PATH_OK, PATH_MISSING, PATH_NOT_VISIBLE
 
 UI_PATH = '/com/github/maoschanz/DynamicWallpaperEditor/ui/'
 
 class DWEPictureWidget(Gtk.Box):
+	THUMBNAIL_SIZE = (114, 64) # this size is totally arbitrary (at zoom 1)
 
 	def __init__(self, pic_structure, window):
 		super().__init__()
-		self.pic_id = pic_structure['pic_id']
-		self.filename = pic_structure['path']
-		self.indx = pic_structure['index']
+		self.pic_id = pic_structure.pic_id
+		self.filename = pic_structure.path
+		self.indx = pic_structure.index
 		self.window = window
 		self._static_time_lock = False
 		self._transition_time_lock = False
-
-	def build_ui(self, stt, trt, template, w, h):
-		builder = Gtk.Builder().new_from_resource(UI_PATH + template)
-		pic_box = builder.get_object('pic_box')
-		self.time_box = builder.get_object('time_box')
-
+		self._is_binding = False
+		self._thumbnail_request = None
+		self._thumbnail_key = None # what the displayed thumbnail is for
+		self._requested_key = None
+		self._path_status = None # not checked yet
+		self.connect('destroy', self.cancel_thumbnail)
+		self.connect('notify::scale-factor', self.refresh_thumbnail)
+
+	def build_ui(self, stt, trt):
+		"""The widgets are created by the template of the concrete class,
+		here their signals are connected and their values are set."""
 		# Thumbnail
-		self.image = builder.get_object('pic_thumbnail')
-		# self.generate_thumbnail() will be called later by self.update_for_current_file
+		self.set_thumbnail_placeholder()
+		# self.load_thumbnail() will be called later by the view's scheduler
 
-		# File name
-		self.label_widget = builder.get_object('pic_label')
+		# File name and schedule labels
 		self.label_widget.set_ellipsize(Pango.EllipsizeMode.START)
-		GLib.timeout_add(500, self.update_for_current_file, {})
-
-		# Schedule labels
-		self.static_label = builder.get_object('static_label')
+		self.info_label.set_ellipsize(Pango.EllipsizeMode.END)
+		self.info_label.set_label("")
 		self.static_label.set_ellipsize(Pango.EllipsizeMode.START)
-		self.transition_label = builder.get_object('transition_label')
 		self.transition_label.set_ellipsize(Pango.EllipsizeMode.START)
 
 		# Pic controls
-		delete_btn = builder.get_object('delete_btn')
-		delete_btn.connect('clicked', self.destroy_pic)
-		self.menu_btn = builder.get_object('menu_btn')
-		builder.add_from_resource(UI_PATH + 'picture_menu.ui')
-		self.menu_btn.set_menu_model( builder.get_object('pic-menu') )
+		self.delete_btn.connect('clicked', self.destroy_pic)
+		self.menu_btn.connect('clicked', self.on_menu_clicked)
 
 		# Picture durations
-		self.static_time_btn = builder.get_object('static_btn')
-		self.trans_time_btn = builder.get_object('transition_btn')
 		self.static_time_btn.set_value(float(stt))
 		self.trans_time_btn.set_value(float(trt))
 		self.static_time_btn.connect('value-changed', self.on_static_changed)
 		self.trans_time_btn.connect('value-changed', self.on_transition_changed)
 
 		# Ability to be dragged
-		pic_box.drag_source_set(Gdk.ModifierType.BUTTON1_MASK, None, Gdk.DragAction.MOVE)
-		pic_box.connect('drag-data-get', self.on_drag_data_get)
-		pic_box.drag_source_add_text_targets()
+		self.pic_box.drag_source_set(Gdk.ModifierType.BUTTON1_MASK, None, \
+		                                                    Gdk.DragAction.MOVE)
+		self.pic_box.connect('drag-data-get', self.on_drag_data_get)
+		self.pic_box.drag_source_add_text_targets()
 
 		# Ability to receive drop
 		self.drag_dest_set(Gtk.DestDefaults.ALL, [], Gdk.DragAction.MOVE)
 		self.connect('drag-data-received', self.on_drag_data_received)
 		self.drag_dest_add_text_targets()
 
-		self.add(pic_box)
-		return builder
-
 	def end_build_ui(self):
+		self.update_for_current_file()
 		self.show_all()
 		is_global = self.window.lookup_action('same_duration').get_state()
 		is_daylight = self.window.lookup_action('total_24').get_state()
@@ -90,6 +87,48 @@ class DWEPictureWidget(Gtk.Box):
 
 	############################################################################
 
+	def bind(self, pic_structure):
+		"""Display the picture `pic_structure` (a record from the data model).
+		The view calls it to recycle the widget when the user scrolls, or to
+		update the widget when its picture has been edited."""
+		self._is_binding = True
+		self.pic_id = pic_structure.pic_id
+		self.indx = pic_structure.index
+		if self.filename != pic_structure.path:
+			self.cancel_thumbnail() # the old picture isn't needed anymore
+			self.filename = pic_structure.path
+			self._path_status = None
+			self.set_tooltip_text(None)
+			self.time_box.set_sensitive(True)
+			self.set_thumbnail_placeholder()
+			self.update_for_current_file()
+		else:
+			self.refresh_thumbnail() # the request may have been cancelled
+		self.set_new_static(pic_structure.static)
+		self.set_new_transition(pic_structure.transition)
+		self._is_binding = False
+
+	def unbind(self):
+		"""Keep the pending edits of the durations before the widget is bound
+		to another picture, and forget its thumbnail request. The edits are
+		applied later because the view is updating while the model notifies
+		its observers."""
+		if self._static_time_lock:
+			self._static_time_lock = False
+			GLib.idle_add(self._edit_duration, self.pic_id, 'static', \
+			                                   self.static_time_btn.get_value())
+		if self._transition_time_lock:
+			self._transition_time_lock = False
+			GLib.idle_add(self._edit_duration, self.pic_id, 'transition', \
+			                                    self.trans_time_btn.get_value())
+		self.cancel_thumbnail()
+
+	############################################################################
+
+	def on_menu_clicked(self, *args):
+		# The menu is shared by all the pictures of the view
+		self.window.view.popup_picture_menu(self)
+
 	def on_drag_data_get(self, widget, drag_context, data, info, time):
 		data.set_text(str(self.indx), -1)
 
@@ -110,26 +149,122 @@ class DWEPictureWidget(Gtk.Box):
 		self.filename = self.filename.replace(searched_str, new_str)
 		self.update_for_current_file()
 
-	def update_for_current_file(self, content_params={}):
+	def update_for_current_file(self):
 		self.label_widget.set_label(self.filename)
-		# the concrete classes will call generate_thumbnail themselves
-		return False
+		self.refresh_thumbnail()
+
+	def set_picture_info(self, info, is_mismatched, usual_resolution):
+		"""Show the format, resolution and size of the file, read from its
+		header. The resolution is emphasized if it's not the same as most other
+		pictures."""
+		style = self.info_label.get_style_context()
+		if info is None:
+			self.info_label.set_label("")
+			style.remove_class('warning')
+			return
+		label = info.to_string()
+		if is_mismatched:
+			label = _("%s – most pictures are %s×%s") % (label, \
+			                                usual_resolution[0], usual_resolution[1])
+			style.add_class('warning')
+		else:
+			style.remove_class('warning')
+		self.info_label.set_label(label)
+		self.info_label.set_tooltip_text(label)
+
+	def set_path_status(self, status):
+		"""Show whether the file exists, as told by the window's path checker.
+		Nothing is loaded for a file which doesn't exist, and the thumbnail is
+		loaded as soon as the file appears."""
+		if status == self._path_status:
+			return
+		was_ok = self._path_status in (None, PATH_OK)
+		self._path_status = status
+		if status in (None, PATH_OK):
+			self.set_tooltip_text(None)
+			self.time_box.set_sensitive(True)
+			if not was_ok:
+				self.set_thumbnail_placeholder()
+				self.refresh_thumbnail()
+			return
+		self.window.view.thumbnail_scheduler.unschedule(self)
+		self.cancel_thumbnail()
+		self._thumbnail_key = None
+		if status == PATH_NOT_VISIBLE:
+			# The durations can still be edited
+			self.image.set_from_icon_name('face-uncertain-symbolic', \
+			                                                 Gtk.IconSize.DIALOG)
+			self.set_tooltip_text(_("This picture might exist, but " + \
+			             "it isn't in your home folder so I can't see it."))
+			self.time_box.set_sensitive(True)
+			return
+		self.image.set_from_icon_name('dialog-error-symbolic', Gtk.IconSize.DIALOG)
+		if status == PATH_MISSING:
+			self.set_tooltip_text(_("This picture doesn't exist"))
+		else:
+			self.set_tooltip_text(_("This picture can't be read"))
+		self.time_box.set_sensitive(False)
+
+	def get_thumbnail_key(self):
+		"""The thumbnail depends on the file, on the zoom level of the view,
+		and on the scale factor of the monitor."""
+		width, height = self.window.view.thumbnail_size
+		return (self.filename, width, height, self.get_scale_factor())
+
+	def refresh_thumbnail(self, *args):
+		"""Load the thumbnail again if the displayed one doesn't fit anymore,
+		for example because the window moved to a HiDPI monitor."""
+		width, height = self.window.view.thumbnail_size
+		self.image.set_size_request(width, height)
+		if self._path_status not in (None, PATH_OK):
+			return
+		key = self.get_thumbnail_key()
+		if self._thumbnail_key == key:
+			return
+		if self._thumbnail_request is None or self._requested_key != key:
+			self.window.view.thumbnail_scheduler.schedule(self)
+
+	def load_thumbnail(self):
+		self._requested_key = self.get_thumbnail_key()
+		path, width, height, scale = self._requested_key
+		self.generate_thumbnail(width * scale, height * scale)
+
+	def set_thumbnail_placeholder(self):
+		self.image.set_from_icon_name('image-x-generic-symbolic', \
+		                                                 Gtk.IconSize.DIALOG)
 
 	def generate_thumbnail(self, w, h):
-		self.time_box.set_sensitive(True)
-		try:
-			# This size is totally arbitrary.
-			pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(self.filename, w, h, True)
-			self.image.set_from_pixbuf(pixbuf)
-		except Exception:
-			if self.filename[:6] != '/home/':
-				self.image.set_from_icon_name('face-uncertain-symbolic', Gtk.IconSize.DIALOG)
-				self.set_tooltip_text(_("This picture might exist, but " + \
-				             "it isn't in your home folder so I can't see it."))
-			else:
-				self.image.set_from_icon_name('dialog-error-symbolic', Gtk.IconSize.DIALOG)
-				self.set_tooltip_text(_("This picture doesn't exist"))
-				self.time_box.set_sensitive(False)
+		"""Ask the application's loader to decode the thumbnail in the
+		background, `w` and `h` being in device pixels. A previous request for
+		an outdated path is cancelled."""
+		self.cancel_thumbnail()
+		loader = self.window.app.thumbnail_loader
+		self._thumbnail_request = loader.request(self.filename, w, h, \
+		                                              self.on_thumbnail_loaded)
+
+	def cancel_thumbnail(self, *args):
+		if self._thumbnail_request is not None:
+			self._thumbnail_request.cancel()
+			self._thumbnail_request = None
+
+	def on_thumbnail_loaded(self, pixbuf, error):
+		self._thumbnail_request = None
+		self._thumbnail_key = self._requested_key
+		if pixbuf is not None:
+			# The surface has as many pixels as the device, but its size in
+			# logical pixels is the one of the view
+			scale = self._thumbnail_key[3]
+			surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, scale, \
+			                                                 self.get_window())
+			self.image.set_from_surface(surface)
+			self.set_tooltip_text(None)
+		elif self._path_status in (None, PATH_OK):
+			# Whether the file exists is told by the path checker, so this is
+			# a file which isn't a picture, or a broken one
+			self.image.set_from_icon_name('image-missing-symbolic', \
+			                                                 Gtk.IconSize.DIALOG)
+			self.set_tooltip_text(_("This file can't be displayed") + \
+			                                                  "\n" + str(error))
 
 	############################################################################
 
@@ -138,6 +273,10 @@ class DWEPictureWidget(Gtk.Box):
 			self.static_time_btn.set_value(new_static)
 
 	def on_static_changed(self, *args):
+		if self._is_binding:
+			self.static_time_btn.set_tooltip_text(time_to_string( \
+			                                  self.static_time_btn.get_value()))
+			return
 		if not self._static_time_lock:
 			GLib.timeout_add(500, self._trigger_static_operation, {})
 		self._static_time_lock = True
@@ -147,12 +286,21 @@ class DWEPictureWidget(Gtk.Box):
 
 		time = self.static_time_btn.get_value()
 		self.static_time_btn.set_tooltip_text(time_to_string(time))
+		return self._edit_duration(self.pic_id, 'static', time)
+
+	def _edit_duration(self, pic_id, field, time):
+		data_model = self.window._data_model
+		if not data_model.has_picture(pic_id):
+			return False # it has been deleted in the meantime
+		if time == getattr(data_model.get_picture(pic_id), field):
+			return False # the value comes from the model (undo, etc.)
 		operation = {
 			'type': 'edit',
-			'pic_id': self.pic_id,
-			'static': time,
+			'pic_id': pic_id,
+			field: time,
 		}
-		self.window._data_model.do_operation(operation)
+		data_model.do_operation(operation)
+		return False
 
 	### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 
@@ -161,6 +309,10 @@ class DWEPictureWidget(Gtk.Box):
 			self.trans_time_btn.set_value(new_transition)
 
 	def on_transition_changed(self, *args):
+		if self._is_binding:
+			self.trans_time_btn.set_tooltip_text(time_to_string( \
+			                                   self.trans_time_btn.get_value()))
+			return
 		if not self._transition_time_lock:
 			GLib.timeout_add(500, self._trigger_transition_operation, {})
 		self._transition_time_lock = True
@@ -170,15 +322,14 @@ class DWEPictureWidget(Gtk.Box):
 
 		time = self.trans_time_btn.get_value()
 		self.trans_time_btn.set_tooltip_text(time_to_string(time))
-		operation = {
-			'type': 'edit',
-			'pic_id': self.pic_id,
-			'transition': time,
-		}
-		self.window._data_model.do_operation(operation)
+		return self._edit_duration(self.pic_id, 'transition', time)
 
 	############################################################################
 
+	def update_daylight_labels(self, start_time):
+		end_time = self.update_static_label(start_time)
+		return self.update_transition_label(end_time)
+
 	def update_static_label(self, prev):
 		msg = _("This picture lasts from {0} to {1}")
 		msg, new_end = self.update_label_common(prev, self.static_time_btn, msg)
@@ -196,10 +347,7 @@ class DWEPictureWidget(Gtk.Box):
 			return "", prev
 
 		# Calculate the next time available
-		hours, mins, seconds = get_hms(btn.get_value())
-		total = ((prev[0] + hours) * 60 + prev[1] + mins) * 60 + prev[2] + seconds
-		h, m, s = get_hms(total)
-		new_end = [h % 24, m, s]
+		new_end = add_duration(prev, btn.get_value())
 
 		# Create strings that show time
 		start_time = ':'.join([str(time) if time > 9 else "0" + str(time) for time in prev])
@@ -218,40 +366,55 @@ class DWEPictureWidget(Gtk.Box):
 	############################################################################
 ################################################################################
 
+@Gtk.Template(resource_path = UI_PATH + 'picture_row.ui')
 class DWEPictureRow(DWEPictureWidget):
 	__gtype_name__ = 'DWEPictureRow'
 
+	pic_box = Gtk.Template.Child()
+	time_box = Gtk.Template.Child()
+	image = Gtk.Template.Child('pic_thumbnail')
+	label_widget = Gtk.Template.Child('pic_label')
+	info_label = Gtk.Template.Child()
+	static_label = Gtk.Template.Child()
+	transition_label = Gtk.Template.Child()
+	delete_btn = Gtk.Template.Child()
+	menu_btn = Gtk.Template.Child()
+	static_time_btn = Gtk.Template.Child('static_btn')
+	trans_time_btn = Gtk.Template.Child('transition_btn')
+
 	def __init__(self, pic_structure, window):
 		super().__init__(pic_structure, window)
-		stt = pic_structure['static']
-		trt = pic_structure['transition']
-		builder = self.build_ui(stt, trt, 'picture_row.ui', 114, 64)
-		# ... ?
+		self.build_ui(pic_structure.static, pic_structure.transition)
 		self.end_build_ui()
 
-	def update_for_current_file(self, content_params={}):
-		super().update_for_current_file()
-		self.generate_thumbnail(114, 64)
-		return False
-
 	############################################################################
 ################################################################################
 
+@Gtk.Template(resource_path = UI_PATH + 'picture_thumbnail.ui')
 class DWEPictureThumbnail(DWEPictureWidget):
 	__gtype_name__ = 'DWEPictureThumbnail'
+	THUMBNAIL_SIZE = (250, 140)
+
+	pic_box = Gtk.Template.Child()
+	time_box = Gtk.Template.Child()
+	image = Gtk.Template.Child('pic_thumbnail')
+	label_widget = Gtk.Template.Child('pic_label')
+	info_label = Gtk.Template.Child()
+	static_label = Gtk.Template.Child()
+	transition_label = Gtk.Template.Child()
+	delete_btn = Gtk.Template.Child()
+	menu_btn = Gtk.Template.Child()
+	static_time_btn = Gtk.Template.Child('static_btn')
+	trans_time_btn = Gtk.Template.Child('transition_btn')
+	time_popover = Gtk.Template.Child()
+	alt_label = Gtk.Template.Child()
+	time_btn = Gtk.Template.Child()
 
 	def __init__(self, pic_structure, window):
 		super().__init__(pic_structure, window)
-		stt = pic_structure['static']
-		trt = pic_structure['transition']
-		builder = self.build_ui(stt, trt, 'picture_thumbnail.ui', 250, 140)
-
-		builder.get_object('time_popover').popdown()
-		self.alt_label = builder.get_object('alt_label')
-		self.alt_label.set_label("…" + self.filename[-20:])
+		self.build_ui(pic_structure.static, pic_structure.transition)
+		self.time_popover.popdown()
 		self.alt_label.set_ellipsize(Pango.EllipsizeMode.START)
-		self.time_btn = builder.get_object('time_btn')
-
 		self.end_build_ui()
 
 	def update_to_type(self, is_global, is_daylight):
@@ -259,10 +422,9 @@ class DWEPictureThumbnail(DWEPictureWidget):
 		self.alt_label.set_visible(is_global)
 		self.time_btn.set_visible(not is_global)
 
-	def update_for_current_file(self, content_params={}):
+	def update_for_current_file(self):
 		super().update_for_current_file()
-		self.generate_thumbnail(250, 140)
-		return False
+		self.alt_label.set_label("…" + self.filename[-20:])
 
 	def update_static_label(self, prev):
 		new_end = super().update_static_label(prev)
@@ -0,0 +1,93 @@
+# pixbuf_cache.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+
+class DWEPixbufCache():
+	"""Decoded thumbnails kept in memory, shared by all the views of all the
+	windows. Keys are (path, mtime, size bucket) tuples, so a modified file
+	is never served from the cache. The least recently used pixbufs are
+	forgotten when the total size exceeds the budget.
+
+	It's used from the worker threads of the thumbnail loader, so every
+	access is protected by a lock."""
+
+	def __init__(self, max_bytes):
+		self._lock = threading.Lock()
+		self._pixbufs = OrderedDict()
+		self._total_bytes = 0
+		self._max_bytes = max_bytes
+		self._key_locks = {}
+
+	def get(self, key):
+		with self._lock:
+			pixbuf = self._pixbufs.get(key, None)
+			if pixbuf is not None:
+				self._pixbufs.move_to_end(key)
+			return pixbuf
+
+	def put(self, key, pixbuf):
+		with self._lock:
+			if key in self._pixbufs:
+				self._total_bytes -= self._pixbufs.pop(key).get_byte_length()
+			self._pixbufs[key] = pixbuf
+			self._total_bytes += pixbuf.get_byte_length()
+			self._evict()
+
+	def get_or_load(self, key, load_function):
+		"""Returns the pixbuf cached for `key`, or the one returned by
+		`load_function`, which is then cached. Threads asking for the same
+		key at the same time wait for the first one, so a picture used twice
+		is decoded only once."""
+		pixbuf = self.get(key)
+		if pixbuf is not None:
+			return pixbuf
+		with self._lock:
+			key_lock = self._key_locks.setdefault(key, threading.Lock())
+		try:
+			with key_lock:
+				pixbuf = self.get(key)
+				if pixbuf is None:
+					pixbuf = load_function()
+					self.put(key, pixbuf)
+				return pixbuf
+		finally:
+			with self._lock:
+				self._key_locks.pop(key, None)
+
+	def set_max_bytes(self, max_bytes):
+		with self._lock:
+			self._max_bytes = max_bytes
+			self._evict()
+
+	def clear(self):
+		with self._lock:
+			self._pixbufs.clear()
+			self._total_bytes = 0
+
+	############################################################################
+
+	def _evict(self):
+		# The most recent pixbuf is always kept, even if it's too big
+		while self._total_bytes > self._max_bytes and len(self._pixbufs) > 1:
+			key, pixbuf = self._pixbufs.popitem(last=False)
+			self._total_bytes -= pixbuf.get_byte_length()
+
+	############################################################################
+################################################################################
+
@@ -0,0 +1,140 @@
+# thumbnail_cache.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, hashlib, tempfile
+from gi.repository import Gio, GdkPixbuf, GLib
+
+# Sizes of the folders defined by the freedesktop thumbnail specification
+THUMBNAIL_LEVELS = [
+	('normal', 128),
+	('large', 256),
+	('x-large', 512),
+	('xx-large', 1024),
+]
+
+class DWEThumbnailCache():
+	"""Persistent thumbnails, stored in `~/.cache/thumbnails` as described by
+	the freedesktop thumbnail specification: the file name is the MD5 of the
+	URI, and the PNG tells the mtime and size of the source file, so outdated
+	thumbnails are detected. Thumbnails generated by other applications (file
+	managers, etc.) are used too.
+
+	The methods of this class are called from the worker threads of the
+	thumbnail loader, and never touch any widget."""
+
+	def __init__(self):
+		self._cache_dir = os.path.join(self._get_user_cache_dir(), 'thumbnails')
+
+	def _get_user_cache_dir(self):
+		"""In a Flatpak sandbox, the cache directory known by GLib is private
+		to the application, so the cache directory of the host is used instead:
+		the manifest gives access to its `thumbnails` folder only."""
+		if not os.path.exists('/.flatpak-info'):
+			return GLib.get_user_cache_dir()
+		host_cache_dir = os.environ.get('HOST_XDG_CACHE_HOME', '')
+		if host_cache_dir != '':
+			return host_cache_dir
+		return os.path.join(GLib.get_home_dir(), '.cache')
+
+	def query_file(self, path, cancellable):
+		"""Returns the GFile, the mtime and the size (as strings, like in the
+		metadata of the thumbnails) of the picture at `path`."""
+		gfile = Gio.File.new_for_path(path)
+		info = gfile.query_info('time::modified,standard::size', \
+		                             Gio.FileQueryInfoFlags.NONE, cancellable)
+		mtime = str(info.get_attribute_uint64('time::modified'))
+		return gfile, mtime, str(info.get_size())
+
+	def get_level_size(self, width, height):
+		"""Returns the size of the smallest level big enough to contain a
+		`width`×`height` thumbnail."""
+		for level, level_size in THUMBNAIL_LEVELS:
+			if level_size >= width and level_size >= height:
+				return level_size
+		return THUMBNAIL_LEVELS[-1][1]
+
+	def load(self, gfile, mtime, size, level_size, cancellable):
+		"""Returns the thumbnail of `gfile` at the given level, generating and
+		storing it first if needed."""
+		uri = gfile.get_uri()
+		thumb_path = self._get_thumbnail_path(uri, level_size)
+		pixbuf = self._load_valid_thumbnail(thumb_path, uri, mtime, size)
+		if pixbuf is None:
+			stream = gfile.read(cancellable)
+			try:
+				pixbuf = GdkPixbuf.Pixbuf.new_from_stream_at_scale(stream, \
+				                       level_size, level_size, True, cancellable)
+			finally:
+				stream.close(None)
+			self._save_thumbnail(pixbuf, thumb_path, uri, mtime, size)
+		return pixbuf
+
+	def scale_to_fit(self, pixbuf, width, height):
+		ratio = min(width / pixbuf.get_width(), height / pixbuf.get_height())
+		if ratio >= 1:
+			return pixbuf
+		new_width = max(1, round(pixbuf.get_width() * ratio))
+		new_height = max(1, round(pixbuf.get_height() * ratio))
+		return pixbuf.scale_simple(new_width, new_height, \
+		                                          GdkPixbuf.InterpType.BILINEAR)
+
+	############################################################################
+
+	def _get_thumbnail_path(self, uri, level_size):
+		level = dict((size, name) for name, size in THUMBNAIL_LEVELS)[level_size]
+		name = hashlib.md5(uri.encode('utf-8')).hexdigest() + '.png'
+		return os.path.join(self._cache_dir, level, name)
+
+	def _load_valid_thumbnail(self, thumb_path, uri, mtime, size):
+		if not os.path.exists(thumb_path):
+			return None
+		try:
+			pixbuf = GdkPixbuf.Pixbuf.new_from_file(thumb_path)
+		except Exception:
+			return None # broken or partially written by someone else
+		if pixbuf.get_option('tEXt::Thumb::URI') != uri:
+			return None
+		if pixbuf.get_option('tEXt::Thumb::MTime') != mtime:
+			return None
+		cached_size = pixbuf.get_option('tEXt::Thumb::Size')
+		if cached_size is not None and cached_size != size:
+			return None
+		return pixbuf
+
+	def _save_thumbnail(self, pixbuf, thumb_path, uri, mtime, size):
+		"""Write the thumbnail to a temporary file which is then renamed, so
+		other applications never read a partial PNG. Failing to write isn't an
+		error: the thumbnail will just be decoded again next time."""
+		thumb_dir = os.path.dirname(thumb_path)
+		tmp_path = None
+		try:
+			os.makedirs(thumb_dir, mode=0o700, exist_ok=True)
+			fd, tmp_path = tempfile.mkstemp(suffix='.png', dir=thumb_dir)
+			os.close(fd)
+			pixbuf.savev(tmp_path, 'png', \
+			    ['tEXt::Thumb::URI', 'tEXt::Thumb::MTime', 'tEXt::Thumb::Size'], \
+			                                                  [uri, mtime, size])
+			os.chmod(tmp_path, 0o600)
+			os.replace(tmp_path, thumb_path)
+		except Exception as err:
+			print("can't cache the thumbnail of", uri, ":", err)
+			if tmp_path is not None and os.path.exists(tmp_path):
+				os.remove(tmp_path)
+
+	############################################################################
+################################################################################
+
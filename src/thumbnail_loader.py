@@ -0,0 +1,267 @@
+# thumbnail_loader.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, threading, heapq, itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from gi.repository import Gio, GLib
+
+from .thumbnail_cache import DWEThumbnailCache
+from .thumbnail_cache import THUMBNAIL_LEVELS
+
+# Maximum time (in microseconds) spent in one iteration of the main loop by
+# the idle callbacks of this module, so the UI stays responsive
+TIME_SLICE = 8000
+
+# Queues of `DWEThumbnailLoader.run_in_worker`
+QUEUE_THUMBNAILS = 'thumbnails'
+QUEUE_BACKGROUND = 'background'
+QUEUE_DOCUMENT = 'document'
+
+class DWETask():
+	"""A job run on a worker thread by `DWEThumbnailLoader.run_in_worker`.
+	The callback is called on the main loop with the result (or None) and the
+	error (or None), unless the task has been cancelled before. The job can
+	check `is_cancelled` to stop early, or give the cancellable to Gio."""
+
+	def __init__(self, callback):
+		self.callback = callback
+		self.cancellable = Gio.Cancellable()
+
+	def cancel(self):
+		self.cancellable.cancel()
+
+	def is_cancelled(self):
+		return self.cancellable.is_cancelled()
+
+	############################################################################
+################################################################################
+
+class DWEThumbnailRequest(DWETask):
+	"""A thumbnail waiting to be decoded. The callback is called with the
+	pixbuf (or None) and the error (or None). Without callback, the request
+	only fills the caches."""
+
+	def __init__(self, path, width, height, callback):
+		super().__init__(callback)
+		self.path = path
+		self.width = width
+		self.height = height
+
+	############################################################################
+################################################################################
+
+class DWEThumbnailLoader():
+	"""Decode thumbnails on a few worker threads, so the main loop is never
+	blocked by big pictures. Results are given back to the main loop in
+	batches, by a single idle callback."""
+
+	def __init__(self, pixbuf_cache):
+		max_workers = min(4, os.cpu_count() or 1)
+		self._executors = {
+			QUEUE_THUMBNAILS: ThreadPoolExecutor(max_workers=max_workers, \
+			                             thread_name_prefix='dwe-thumbnails'),
+			# Slow tasks which aren't thumbnails (header probing, etc.) have
+			# their own thread, so they never delay visible thumbnails
+			QUEUE_BACKGROUND: ThreadPoolExecutor(max_workers=1, \
+			                             thread_name_prefix='dwe-background'),
+			# Reading and writing the document the user is waiting for, which
+			# shouldn't wait behind the probing of a big folder
+			QUEUE_DOCUMENT: ThreadPoolExecutor(max_workers=1, \
+			                               thread_name_prefix='dwe-document'),
+		}
+		self._disk_cache = DWEThumbnailCache()
+		self._memory_cache = pixbuf_cache
+		self._lock = threading.Lock()
+		self._results = deque()
+		self._is_delivering = False
+
+	def request(self, path, width, height, callback):
+		"""Decode the picture at `path` to fit in `width`×`height` (in device
+		pixels), and return the request, which should be cancelled if the
+		result is no longer needed (the widget is destroyed, the path changed,
+		etc.)"""
+		request = DWEThumbnailRequest(path, width, height, callback)
+		return self.run_in_worker(request, self._load_pixbuf)
+
+	def run_in_worker(self, task, function, queue=QUEUE_THUMBNAILS):
+		"""Call `function(task)` on a worker thread of `queue`. Its result (or
+		the exception it raised) is given to the callback of the `DWETask`, on
+		the main loop, with the other results of the same batch. The background
+		and document queues have a single thread, so their tasks run in the
+		order they were queued."""
+		self._executors[queue].submit(self._run, task, function)
+		return task
+
+	def shutdown(self):
+		for executor in self._executors.values():
+			executor.shutdown(wait=False, cancel_futures=True)
+
+	############################################################################
+	# Worker threads ###########################################################
+
+	def _run(self, task, function):
+		if task.is_cancelled():
+			return
+		result = None
+		error = None
+		try:
+			result = function(task)
+		except Exception as err:
+			error = err
+		if task.is_cancelled():
+			return
+		with self._lock:
+			self._results.append((task, result, error))
+			if self._is_delivering:
+				return
+			self._is_delivering = True
+		GLib.idle_add(self._deliver_results)
+
+	def _load_pixbuf(self, request):
+		"""The thumbnails are cached at a few levels (mipmaps). The level is
+		looked for in the memory cache first, then derived from a larger level
+		in the memory cache, then loaded from the disk cache. The picture is
+		decoded only if none of these has it."""
+		cancellable = request.cancellable
+		gfile, mtime, size = self._disk_cache.query_file(request.path, \
+		                                                           cancellable)
+		level_size = self._disk_cache.get_level_size(request.width, \
+		                                                        request.height)
+		key = (request.path, mtime, level_size)
+		pixbuf = self._memory_cache.get_or_load(key, lambda: \
+		   self._load_level(request.path, gfile, mtime, size, level_size, cancellable))
+		return self._disk_cache.scale_to_fit(pixbuf, request.width, \
+		                                                        request.height)
+
+	def _load_level(self, path, gfile, mtime, size, level_size, cancellable):
+		for larger_level, larger_size in THUMBNAIL_LEVELS:
+			if larger_size <= level_size:
+				continue
+			key = (path, mtime, larger_size)
+			larger_pixbuf = self._memory_cache.get(key)
+			if larger_pixbuf is not None:
+				return self._disk_cache.scale_to_fit(larger_pixbuf, \
+				                                          level_size, level_size)
+		return self._disk_cache.load(gfile, mtime, size, level_size, cancellable)
+
+	############################################################################
+	# Main loop ################################################################
+
+	def _deliver_results(self):
+		"""Call the callbacks of the finished tasks, until the time slice
+		is over. The remaining results are delivered in the next iteration of
+		the main loop."""
+		deadline = GLib.get_monotonic_time() + TIME_SLICE
+		while GLib.get_monotonic_time() < deadline:
+			with self._lock:
+				if len(self._results) == 0:
+					self._is_delivering = False
+					return False
+				task, result, error = self._results.popleft()
+			if task.callback is not None and not task.is_cancelled():
+				task.callback(result, error)
+		return True
+
+	############################################################################
+################################################################################
+
+class DWEThumbnailScheduler():
+	"""Decide in which order the thumbnails of a view are requested: the view
+	gives a priority to each widget (the lowest is loaded first), so visible
+	pictures are loaded before the ones in the overscan area. When nothing
+	visible is waiting, the thumbnails of the next pictures in the direction
+	of the scrolling are prefetched into the caches.
+
+	The work is done in an idle callback, by slices of limited duration."""
+
+	def __init__(self, loader, get_priority):
+		self._loader = loader
+		self._get_priority = get_priority
+		self._heap = []
+		self._pending = {} # sequence numbers of the scheduled widgets
+		self._counter = itertools.count()
+		self._prefetch_paths = []
+		self._prefetch_size = (0, 0)
+		self._prefetch_requests = {} # requests by path
+		self._idle_id = None
+
+	def schedule(self, widget):
+		"""The thumbnail of `widget` will be loaded (by calling its
+		`load_thumbnail` method) according to its priority."""
+		sequence = next(self._counter)
+		self._pending[widget] = sequence
+		heapq.heappush(self._heap, (self._get_priority(widget), sequence, widget))
+		self._queue_work()
+
+	def unschedule(self, widget):
+		# The entry stays in the heap, but it will be skipped
+		self._pending.pop(widget, None)
+
+	def update_priorities(self):
+		"""The priorities depend on the scrolling, so the queue is sorted again
+		when the visible area changed."""
+		self._heap = [(self._get_priority(widget), sequence, widget) \
+		                         for widget, sequence in self._pending.items()]
+		heapq.heapify(self._heap)
+
+	def set_prefetch(self, paths, width, height):
+		"""Replace the list of pictures to prefetch. Requests for pictures no
+		longer in the list are cancelled, because the user scrolled away."""
+		self._prefetch_size = (width, height)
+		self._prefetch_paths = list(reversed(paths))
+		wanted_paths = set(paths)
+		for path in list(self._prefetch_requests.keys()):
+			if path not in wanted_paths:
+				self._prefetch_requests.pop(path).cancel()
+		self._queue_work()
+
+	def clear(self):
+		self._heap = []
+		self._pending = {}
+		self.set_prefetch([], 0, 0)
+		if self._idle_id is not None:
+			GLib.source_remove(self._idle_id)
+			self._idle_id = None
+
+	############################################################################
+
+	def _queue_work(self):
+		if self._idle_id is None:
+			self._idle_id = GLib.idle_add(self._do_work)
+
+	def _do_work(self):
+		deadline = GLib.get_monotonic_time() + TIME_SLICE
+		while GLib.get_monotonic_time() < deadline:
+			if len(self._heap) > 0:
+				priority, sequence, widget = heapq.heappop(self._heap)
+				if self._pending.get(widget, None) == sequence:
+					del self._pending[widget]
+					widget.load_thumbnail()
+			elif len(self._prefetch_paths) > 0:
+				path = self._prefetch_paths.pop()
+				if path not in self._prefetch_requests:
+					width, height = self._prefetch_size
+					self._prefetch_requests[path] = self._loader.request( \
+					                                    path, width, height, None)
+			else:
+				self._idle_id = None
+				return False
+		return True
+
+	############################################################################
+################################################################################
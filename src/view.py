@@ -15,34 +15,103 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk
+from gi.repository import Gtk, GLib
+import math
 
 from .picture_widget import DWEPictureRow
 from .picture_widget import DWEPictureThumbnail
+from .thumbnail_loader import DWEThumbnailScheduler
+from .misc import add_duration
+
+# Number of rows of widgets kept above and below the visible area, so
+# scrolling a little doesn't show empty space
+OVERSCAN_ROWS = 3
+
+UI_PATH = '/com/github/maoschanz/DynamicWallpaperEditor/ui/'
+
+# Number of rows, beyond the overscan, whose thumbnails are loaded in advance
+# in the direction of the scrolling
+PREFETCH_ROWS = 10
+
+def get_picture_menu_model():
+	"""The menu of the pictures is parsed once, and shared by all views."""
+	global _picture_menu_model
+	if _picture_menu_model is None:
+		builder = Gtk.Builder().new_from_resource(UI_PATH + 'picture_menu.ui')
+		_picture_menu_model = builder.get_object('pic-menu')
+	return _picture_menu_model
+
+_picture_menu_model = None
 
 class DWEAbstractView():
+	"""Display the pictures of the data model. Widgets only exist for the
+	pictures in the visible part of the scrolled window (plus a few rows), and
+	they are recycled, i.e. bound to other pictures, when the user scrolls.
+	Spacers above and below the container give the scrolled window the size
+	it would have if all the pictures had a widget."""
 	__gtype_name__ = 'DWEAbstractView'
 
 	def __init__(self, window):
 		self.window = window
 		self._length = 0
+		self._widgets = {} # bound picture widgets by pic_id
+		self._free_widgets = [] # hidden widgets waiting to be bound again
+		self._pictures = [] # pictures matching the search, in model order
+		self._item_size = self.DEFAULT_ITEM_SIZE
+		self._columns = 1
+		self._selected_id = None
+		self._menu_pic_id = None # the picture whose menu is opened
+		self._picture_menu = None
+		self._selection_lock = False
+		self._is_updating = False
+		self._range_idle_id = None
+		self._visible_range = (0, 0)
+		self._positions = {} # positions of the bound pictures by pic_id
+		self._scroll_value = 0
+		self._is_scrolling_up = False
+		self._daylight_start = None # start time of the wallpaper, in 24h mode
 		self.searched_str = ""
+		self.thumbnail_size = self.THUMBNAIL_SIZE
+		self.thumbnail_scheduler = DWEThumbnailScheduler( \
+		                 window.app.thumbnail_loader, self.get_thumbnail_priority)
 
 	def _add_list_container(self, widget):
 		widget.set_sort_func(self.sort_view)
-		widget.set_filter_func(self.filter_view)
-		self.window.scrolled_window.add(widget)
+		widget.connect('size-allocate', self.on_container_allocated)
+		self._top_spacer = Gtk.Box(visible=True)
+		self._bottom_spacer = Gtk.Box(visible=True)
+		box = Gtk.Box(visible=True, orientation=Gtk.Orientation.VERTICAL)
+		box.pack_start(self._top_spacer, False, False, 0)
+		box.pack_start(widget, False, False, 0)
+		box.pack_start(self._bottom_spacer, True, True, 0)
+		self.window.scrolled_window.add(box)
+
+		scrolled_window = self.window.scrolled_window
+		self._handlers = [
+			(scrolled_window.get_vadjustment(), scrolled_window.get_vadjustment(). \
+			                       connect('value-changed', self.on_scrolled)),
+			(scrolled_window, scrolled_window.connect('size-allocate', \
+			                                      self.on_scrolled_allocated)),
+		]
 
 	def destroy(self):
-		for w in self.get_view_widget().get_children():
-			w.destroy()
+		self.thumbnail_scheduler.clear()
+		if self._picture_menu is not None:
+			self._picture_menu.destroy()
+			self._picture_menu = None
+		for gobject, handler_id in self._handlers:
+			gobject.disconnect(handler_id)
+		if self._range_idle_id is not None:
+			GLib.source_remove(self._range_idle_id)
+		for pic_id in list(self._widgets.keys()):
+			self._unbind_widget(pic_id)
+		for widget in self._free_widgets:
+			widget.get_parent().destroy()
+		self._free_widgets = []
 		child = self.window.scrolled_window.get_child()
 		self.window.scrolled_window.remove(child)
 		child.destroy()
 
-	def set_unsaved(self):
-		self.window._is_saved = False
-
 	def update_subtitle(self, is_empty):
 		if is_empty:
 			label = _("Add new pictures, or open an existing XML file.")
@@ -52,52 +121,259 @@ class DWEAbstractView():
 
 	############################################################################
 
-	def update(self, dw_data):
-		widgets = self.get_view_widget().get_children()
-		delta_removed = []
-		delta_added = []
-		for p in dw_data['pictures']:
-			delta_added.append(p['pic_id'])
-		for w in widgets:
-			widget_pic_id = w.get_child().pic_id
-			if widget_pic_id in delta_added:
-				delta_added.remove(widget_pic_id)
-			delta_removed.append(widget_pic_id)
-		for p in dw_data['pictures']:
-			if p['pic_id'] in delta_removed:
-				delta_removed.remove(p['pic_id'])
-
-		for w in widgets:
-			row = w.get_child()
-			if row.pic_id in delta_removed:
-				self.get_view_widget().remove(w)
-				w.destroy()
-			else:
-				for p in dw_data['pictures']:
-					if p['pic_id'] == row.pic_id:
-						row.indx = p['index']
-						if row.filename != p['path']:
-							row.filename = p['path']
-							row.update_for_current_file()
-						row.set_new_static(p['static'])
-						row.set_new_transition(p['transition'])
-
-		for pic in dw_data['pictures']:
-			if pic['pic_id'] in delta_added:
-				self._add_one_picture(pic)
-
-		self.get_view_widget().invalidate_sort()
-		self._length = len(self.get_view_widget().get_children())
+	def update(self, delta):
+		"""Apply the changes described by `delta` (a `DWEModelDelta`) to the
+		widgets, which are found by their pic_id. Pictures without a widget
+		don't cost anything."""
+		data_model = self.window._data_model
+		if delta.is_reset:
+			# pic_ids may have been reused by completely different pictures
+			for pic_id in list(self._widgets.keys()):
+				self._unbind_widget(pic_id)
+
+		needs_filter = delta.is_reset or delta.removed or delta.added \
+		                                           or delta.reordered is not None
+		for pic_id, fields in delta.changed.items():
+			widget = self._widgets.get(pic_id, None)
+			if 'path' in fields and self.searched_str != "":
+				needs_filter = True # the picture may (not) match anymore
+			if widget is not None:
+				widget.bind(data_model.get_picture(pic_id))
+				self._update_path_status(widget)
+
+		if needs_filter:
+			self._filter_pictures()
+		self._update_visible_range()
+
+		self._length = len(data_model.get_pictures())
 		self.update_subtitle(self._length == 0)
+		if self._daylight_start is not None and self._moves_timings(delta):
+			self.update_daylight_timings(self._daylight_start)
 		self.window.update_status()
 
+	def _moves_timings(self, delta):
+		"""Tell if the start times of some pictures changed."""
+		if delta.is_reset or delta.added or delta.removed \
+		                                           or delta.reordered is not None:
+			return True
+		for fields in delta.changed.values():
+			if 'static' in fields or 'transition' in fields:
+				return True
+		return False
+
+	def _filter_pictures(self):
+		pictures = self.window._data_model.get_pictures()
+		if self.searched_str == "":
+			self._pictures = pictures
+		else:
+			self._pictures = [pic for pic in pictures \
+			                           if self.searched_str in pic.path.lower()]
+
+	############################################################################
+	# Virtualization ###########################################################
+
+	def on_scrolled(self, *args):
+		self._update_visible_range()
+
+	def on_scrolled_allocated(self, *args):
+		self._queue_update_visible_range()
+
+	def on_container_allocated(self, container, allocation):
+		"""The actual height of the rows is only known once the widgets are
+		allocated, and may differ from the estimation."""
+		nb_shown = len(self._widgets)
+		if nb_shown == 0:
+			return
+		nb_rows = math.ceil(nb_shown / self._columns)
+		item_height = allocation.height / nb_rows
+		if abs(item_height - self._item_size[1]) >= 1:
+			self._item_size = (self._item_size[0], item_height)
+			self._queue_update_visible_range()
+
+	def _queue_update_visible_range(self):
+		if self._range_idle_id is None:
+			self._range_idle_id = GLib.idle_add(self._on_idle_update_range)
+
+	def _on_idle_update_range(self):
+		self._range_idle_id = None
+		self._update_visible_range()
+		return False
+
+	def _update_visible_range(self):
+		"""Bind widgets to the pictures in the visible area, recycling the
+		widgets of pictures which are not visible anymore, and resize the
+		spacers accordingly."""
+		if self._is_updating:
+			return
+		self._is_updating = True
+		adjustment = self.window.scrolled_window.get_vadjustment()
+		item_width, item_height = self._item_size
+		self._update_columns(item_width)
+		nb_rows = math.ceil(len(self._pictures) / self._columns)
+
+		value = adjustment.get_value()
+		if value != self._scroll_value:
+			self._is_scrolling_up = value < self._scroll_value
+			self._scroll_value = value
+		visible_first = int(value / item_height)
+		visible_last = int((value + adjustment.get_page_size()) / item_height) + 1
+		self._visible_range = (visible_first * self._columns, \
+		                                           visible_last * self._columns)
+		first_row = max(0, visible_first - OVERSCAN_ROWS)
+		last_row = max(first_row, min(nb_rows, visible_last + OVERSCAN_ROWS))
+		start = first_row * self._columns
+		stop = last_row * self._columns
+		wanted = self._pictures[start:stop]
+		self._positions = dict((pic.pic_id, start + i) \
+		                                       for i, pic in enumerate(wanted))
+
+		wanted_ids = set(pic.pic_id for pic in wanted)
+		for pic_id in list(self._widgets.keys()):
+			if pic_id not in wanted_ids:
+				self._unbind_widget(pic_id)
+		needs_sort = False
+		for pic in wanted:
+			widget = self._widgets.get(pic.pic_id, None)
+			if widget is None:
+				self._bind_widget(pic)
+				needs_sort = True
+			elif widget.indx != pic.index:
+				widget.bind(pic)
+				needs_sort = True
+		if needs_sort:
+			self.get_view_widget().invalidate_sort()
+		self.thumbnail_scheduler.update_priorities()
+		self._prefetch_thumbnails(start, stop)
+
+		self._top_spacer.set_size_request(-1, int(first_row * item_height))
+		bottom_height = (nb_rows - last_row) * item_height
+		self._bottom_spacer.set_size_request(-1, int(bottom_height))
+		self._sync_selection()
+		self._is_updating = False
+
+	def _update_columns(self, item_width):
+		pass # Implemented in non-abstract classes
+
+	def get_thumbnail_priority(self, widget):
+		"""Visible pictures come first, from the top, then the pictures in the
+		overscan area, in the direction of the scrolling first."""
+		position = self._positions.get(widget.pic_id, 0)
+		visible_start, visible_stop = self._visible_range
+		if position < visible_start:
+			distance = visible_start - position
+			is_ahead = self._is_scrolling_up
+		elif position >= visible_stop:
+			distance = position - visible_stop + 1
+			is_ahead = not self._is_scrolling_up
+		else:
+			return position - visible_start
+		return distance * (1 if is_ahead else 2) + len(self._positions)
+
+	def _prefetch_thumbnails(self, start, stop):
+		"""Warm the caches with the thumbnails of the pictures which will be
+		bound next if the user keeps scrolling in the same direction."""
+		nb_prefetched = PREFETCH_ROWS * self._columns
+		if self._is_scrolling_up:
+			pictures = reversed(self._pictures[max(0, start - nb_prefetched):start])
+		else:
+			pictures = self._pictures[stop:stop + nb_prefetched]
+		scale = self.window.scrolled_window.get_scale_factor()
+		width, height = self.thumbnail_size
+		paths = [pic.path for pic in pictures]
+		self.thumbnail_scheduler.set_prefetch(paths, width * scale, \
+		                                                        height * scale)
+
+	def _bind_widget(self, pic_structure):
+		if len(self._free_widgets) > 0:
+			widget = self._free_widgets.pop()
+			widget.bind(pic_structure)
+		else:
+			widget = self._build_widget(pic_structure)
+			if len(self._widgets) == 0:
+				self._measure_item(widget)
+		self._widgets[widget.pic_id] = widget
+		self._update_picture_info(widget)
+		self._update_path_status(widget)
+		if self._daylight_start is not None:
+			widget.update_daylight_labels(self._get_daylight_start(widget.pic_id))
+		widget.get_parent().set_visible(True)
+		return widget
+
+	def update_picture_infos(self, pic_ids):
+		"""Show the new infos about the pictures in `pic_ids`, or about all
+		pictures if it's None."""
+		for widget in self._widgets.values():
+			if pic_ids is None or widget.pic_id in pic_ids:
+				self._update_picture_info(widget)
+
+	def _update_picture_info(self, widget):
+		checker = self.window.resolution_checker
+		info = checker.get_info(widget.pic_id)
+		widget.set_picture_info(info, checker.is_mismatched(widget.pic_id), \
+		                                             checker.get_most_common())
+
+	def update_path_statuses(self, pic_ids):
+		for widget in self._widgets.values():
+			if widget.pic_id in pic_ids:
+				self._update_path_status(widget)
+
+	def _update_path_status(self, widget):
+		status = self.window.path_checker.get_status(widget.pic_id)
+		widget.set_path_status(status)
+
+	def _unbind_widget(self, pic_id):
+		widget = self._widgets.pop(pic_id)
+		if self._picture_menu is not None \
+		               and self._picture_menu.get_relative_to() is widget.menu_btn:
+			self._picture_menu.popdown()
+			self._picture_menu.set_relative_to(None)
+		self.thumbnail_scheduler.unschedule(widget)
+		widget.unbind()
+		widget.get_parent().set_visible(False)
+		self._free_widgets.append(widget)
+
+	def _measure_item(self, widget):
+		child = widget.get_parent()
+		width = child.get_preferred_width()[1]
+		height = child.get_preferred_height_for_width(width)[1]
+		if width > 0 and height > 0:
+			self._item_size = (width, height)
+			self._queue_update_visible_range()
+
+	############################################################################
+	# Selection ################################################################
+
+	def on_selection_changed(self, *args):
+		if self._selection_lock:
+			return
+		widget = self.get_selected_child()
+		self._selected_id = None if widget is None else widget.pic_id
+
+	def _sync_selection(self):
+		"""Select the child bound to the selected picture (if it's in the
+		visible range), since the previously selected child may have been bound
+		to another picture."""
+		self._selection_lock = True
+		widget = self._widgets.get(self._selected_id, None)
+		if widget is None:
+			self.get_view_widget().unselect_all()
+		else:
+			self._select_child(widget.get_parent())
+		self._selection_lock = False
+
+	def _select_child(self, child):
+		pass # Implemented in non-abstract classes
+
+	def get_selected_child(self):
+		pass # Implemented in non-abstract classes
+
 	############################################################################
 
 	def get_view_widget(self):
 		pass
 
 	def get_pic_at(self, index):
-		return self.get_view_widget().get_children()[index].get_child()
+		return self.window._data_model.get_pictures()[index]
 
 	def sort_view(self, pic1, pic2, *args):
 		"""Returns int < 0 if pic1 should be before pic2, 0 if they are equal
@@ -105,18 +381,18 @@ class DWEAbstractView():
 		return pic1.get_child().indx - pic2.get_child().indx
 
 	def sort_by_name(self):
-		rows = self.get_view_widget().get_children()
-		images_list = []
-		for r in rows:
-			images_list.append(r.get_child().filename)
-		sorted_list = sorted(images_list, key=self._filter_nums)
-		new_index = 0
-		for fn in sorted_list:
-			for r in rows:
-				if r.get_child().filename == fn:
-					r.get_child().indx = new_index
-			new_index = new_index + 1
-		self.get_view_widget().invalidate_sort()
+		pics = sorted(self.window._data_model.get_pictures(), \
+		                           key=lambda pic: self._filter_nums(pic.path))
+		data_model = self.window._data_model
+		with data_model.transaction():
+			previous_id = None
+			for pic in pics:
+				data_model.do_operation({
+					'type': 'edit',
+					'pic_id': pic.pic_id,
+					'after': previous_id,
+				})
+				previous_id = pic.pic_id
 
 	def _filter_nums(self, full_path):
 		"""If the filename begins with a number, it will sort according to these
@@ -140,32 +416,51 @@ class DWEAbstractView():
 
 	############################################################################
 
-	def _add_one_picture(self, pic_structure):
+	def _build_widget(self, pic_structure):
 		pass # Implemented in non-abstract classes
 
+	def popup_picture_menu(self, widget):
+		"""Show the menu of the picture of `widget`. There is only one popover
+		for all the pictures: the actions of its model apply to the picture it
+		has been opened for."""
+		if self._picture_menu is None:
+			self._picture_menu = Gtk.Popover.new_from_model(widget.menu_btn, \
+			                                          get_picture_menu_model())
+			self._picture_menu.connect('closed', self.on_picture_menu_closed)
+		else:
+			self._picture_menu.set_relative_to(widget.menu_btn)
+		self._menu_pic_id = widget.pic_id
+		self._picture_menu.popup()
+
+	def on_picture_menu_closed(self, *args):
+		# The action of the menu item may be activated after the closing
+		GLib.idle_add(self._forget_menu_target)
+
+	def _forget_menu_target(self):
+		if self._picture_menu is None or not self._picture_menu.get_visible():
+			self._menu_pic_id = None
+		return False
+
 	def get_active_pic(self):
-		rows = self.get_view_widget().get_children()
-		for r in rows:
-			if r.get_child().menu_btn.get_popover().get_visible():
-				return r.get_child()
+		"""Returns the picture (from the data model) whose menu is opened, or
+		else the selected picture."""
+		pic_id = self._selected_id
+		if self._menu_pic_id is not None:
+			pic_id = self._menu_pic_id
 		# XXX what if nothing is selected?
-		return self.get_selected_child()
-
-	def get_selected_child(self):
-		pass # Implemented in non-abstract classes
+		if pic_id is None:
+			return None
+		return self.window._data_model.get_picture(pic_id)
 
 	def search_pic(self, string):
 		self.searched_str = string.lower()
-		self.get_view_widget().invalidate_filter()
-
-	def filter_view(self, each_pic):
-		target_text = each_pic.get_child().filename.lower()
-		return (self.searched_str in target_text)
+		self._filter_pictures()
+		self._update_visible_range()
 
 	############################################################################
 
 	def rel_move_pic(self, is_down):
-		old_index = self.get_active_pic().indx
+		old_index = self.get_active_pic().index
 		if is_down:
 			new_index = old_index + 1
 		else:
@@ -173,7 +468,7 @@ class DWEAbstractView():
 		self.move_pic(old_index, new_index)
 
 	def abs_move_pic(self, new_index):
-		self.move_pic(self.get_active_pic().indx, new_index)
+		self.move_pic(self.get_active_pic().index, new_index)
 
 	def move_pic(self, index_from, index_to):
 		if index_from > index_to:
@@ -189,93 +484,86 @@ class DWEAbstractView():
 
 	############################################################################
 
-	def get_view_total_time(self):
-		total_time = 0
-		for w in self.get_view_widget().get_children():
-			row = w.get_child()
-			total_time += row.static_time_btn.get_value()
-			total_time += row.trans_time_btn.get_value()
-		return total_time
+	def update_daylight_timings(self, start_time):
+		"""Update the labels of the bound widgets, whose pictures start at
+		`start_time` plus the durations before them, or hide the labels if
+		`start_time` is None. Other widgets will get their labels when they're
+		bound, so the cost doesn't depend on the number of pictures."""
+		self._daylight_start = start_time
+		if start_time is None:
+			return
+		for pic_id, widget in self._widgets.items():
+			widget.update_daylight_labels(self._get_daylight_start(pic_id))
+
+	def _get_daylight_start(self, pic_id):
+		offset = self.window._data_model.get_start_offset(pic_id)
+		return add_duration(self._daylight_start, offset)
 
-	def update_daylight_timings(self, temp_time):
-		for w in self.get_view_widget().get_children():
-			row = w.get_child()
-			temp_time = row.update_static_label(temp_time)
-			temp_time = row.update_transition_label(temp_time)
+	def set_zoom(self, zoom):
+		pass # Only the grid can be zoomed
 
 	def update_to_mode(self, is_global, is_daylight):
-		for index in range(0, self._length):
-			self.get_pic_at(index).update_to_type(is_global, is_daylight)
-
-	def all_have_same_time(self):
-		st0 = self.get_pic_at(0).static_time_btn.get_value()
-		tr0 = self.get_pic_at(0).trans_time_btn.get_value()
-		for index in range(0, self._length):
-			r = self.get_pic_at(index)
-			if st0 != r.static_time_btn.get_value():
-				return False, st0, tr0
-			if tr0 != r.trans_time_btn.get_value():
-				return False, st0, tr0
-		return True, st0, tr0
+		for pic in list(self._widgets.values()) + self._free_widgets:
+			pic.update_to_type(is_global, is_daylight)
 
 	def fix_24(self, *args):
 		"""Automatically set the durations for each picture to reach a total of
 		24 hours, assuming there is only 1 picture for the night, and assuming
 		the night is 40% of a cycle. 5% of the total time is used for
-		transitions."""
-
-		if self._length == 0:
+		transitions. The new durations are computed from the data model, and
+		applied as a single operation."""
+		pictures = self.window._data_model.get_pictures()
+		if len(pictures) == 0:
 			return
-		elif self._length == 1:
+		elif len(pictures) == 1:
 			# Special case
-			self.get_pic_at(0).static_time_btn.set_value(86400)
-			self.get_pic_at(0).trans_time_btn.set_value(0)
+			durations = [[86400, 0]]
 		else:
 			# General case
-			self.fix24_method2()
-			self.fix24_method2()
-			self.fix24_method2()
-
-		# Update the tooltips and the status bar
-		for index in range(0, self._length):
-			self.get_pic_at(index).on_static_changed()
-			self.get_pic_at(index).on_transition_changed()
+			durations = [[pic.static, pic.transition] for pic in pictures]
+			self.fix24_method2(durations)
+			self.fix24_method2(durations)
+			self.fix24_method2(durations)
 
 		# Ensure the total time is actually 86400 despite float → int conversions
-		static0 = self.get_pic_at(0).static_time_btn
-		while self.window.get_total_time() > 86400:
-			static0.set_value(static0.get_value() - 1)
-		while self.window.get_total_time() < 86400:
-			static0.set_value(static0.get_value() + 1)
-
-	def fix24_method2(self):
-		current_total = self.window.get_total_time()
+		total = sum(st + tr for st, tr in durations)
+		durations[0][0] = max(0, durations[0][0] + 86400 - total)
+
+		data_model = self.window._data_model
+		with data_model.transaction():
+			for pic, (static, transition) in zip(pictures, durations):
+				operation = {'type': 'edit', 'pic_id': pic.pic_id}
+				if static != pic.static:
+					operation['static'] = static
+				if transition != pic.transition:
+					operation['transition'] = transition
+				if len(operation) > 2:
+					data_model.do_operation(operation)
+
+	def fix24_method2(self, durations):
+		current_total = sum(st + tr for st, tr in durations)
 		missing_time = 86400 - current_total
-		if missing_time == 0:
+		if missing_time == 0 or current_total == 0:
 			return
-		for index in range(0, self._length):
-			st_spinbtn = self.get_pic_at(index).static_time_btn
-			self.spinbtn_fix24_update(st_spinbtn, current_total, missing_time)
-			tr_spinbtn = self.get_pic_at(index).trans_time_btn
-			self.spinbtn_fix24_update(tr_spinbtn, current_total, missing_time)
-
-	def spinbtn_fix24_update(self, spinbtn, current_total, missing_time):
-		sb_time = spinbtn.get_value()
-		sb_time += (sb_time / current_total) * missing_time
-		spinbtn.set_value(int(sb_time))
+		for times in durations:
+			for i in range(0, 2):
+				times[i] = int(times[i] + (times[i] / current_total) * missing_time)
 
 	############################################################################
 ################################################################################
 
 class DWERowsView(DWEAbstractView):
 	__gtype_name__ = 'DWERowsView'
+	DEFAULT_ITEM_SIZE = (400, 72)
+	THUMBNAIL_SIZE = DWEPictureRow.THUMBNAIL_SIZE
 
 	def __init__(self, window):
 		super().__init__(window)
-		self.list_box = Gtk.ListBox(visible=True, expand=True)
+		self.list_box = Gtk.ListBox(visible=True, hexpand=True)
 		label = Gtk.Label(visible=True, \
 		             label=_("Add new pictures, or open an existing XML file."))
 		self.list_box.set_placeholder(label)
+		self.list_box.connect('row-selected', self.on_selection_changed)
 		self._add_list_container(self.list_box)
 
 	def get_view_widget(self):
@@ -288,20 +576,28 @@ class DWERowsView(DWEAbstractView):
 		else:
 			return row.get_child()
 
-	def _add_one_picture(self, pic_structure):
-		self.set_unsaved()
+	def _select_child(self, child):
+		self.list_box.select_row(child)
+
+	def _build_widget(self, pic_structure):
 		row = DWEPictureRow(pic_structure, self.window)
 		self.list_box.add(row)
+		return row
 
 	############################################################################
 ################################################################################
 
 class DWEThumbnailsView(DWEAbstractView):
 	__gtype_name__ = 'DWEThumbnailsView'
+	DEFAULT_ITEM_SIZE = (270, 200)
+	THUMBNAIL_SIZE = DWEPictureThumbnail.THUMBNAIL_SIZE
 
 	def __init__(self, window):
 		super().__init__(window)
-		self.flow_box = Gtk.FlowBox(visible=True, expand=True)
+		self.flow_box = Gtk.FlowBox(visible=True, hexpand=True, \
+		                                     valign=Gtk.Align.START, homogeneous=True)
+		self.flow_box.connect('selected-children-changed', \
+		                                              self.on_selection_changed)
 		# label = Gtk.Label(visible=True, \
 		#              label=_("Add new pictures, or open an existing XML file."))
 		# self.flow_box.set_placeholder(label)
@@ -317,10 +613,38 @@ class DWEThumbnailsView(DWEAbstractView):
 		else:
 			return children[0].get_child()
 
-	def _add_one_picture(self, pic_structure):
-		self.set_unsaved()
+	def _select_child(self, child):
+		self.flow_box.select_child(child)
+
+	def _update_columns(self, item_width):
+		"""The number of columns is forced, so the rows of the flowbox match
+		the rows used to compute which pictures are visible."""
+		width = self.window.scrolled_window.get_allocated_width()
+		columns = max(1, int(width // max(1, item_width)))
+		if columns != self._columns:
+			self._columns = columns
+			self.flow_box.set_min_children_per_line(columns)
+			self.flow_box.set_max_children_per_line(columns)
+
+	def set_zoom(self, zoom):
+		"""Resize the thumbnails. They're loaded again at the new size, which
+		is fast since smaller levels are derived from the cached ones."""
+		width, height = self.THUMBNAIL_SIZE
+		thumbnail_size = (round(width * zoom), round(height * zoom))
+		if thumbnail_size == self.thumbnail_size:
+			return
+		self.thumbnail_size = thumbnail_size
+		for widget in self._widgets.values():
+			widget.refresh_thumbnail() # free widgets will be refreshed if bound
+		for widget in self._widgets.values():
+			self._measure_item(widget)
+			break
+		self._queue_update_visible_range()
+
+	def _build_widget(self, pic_structure):
 		pic = DWEPictureThumbnail(pic_structure, self.window)
 		self.flow_box.add(pic)
+		return pic
 
 	############################################################################
 ################################################################################
@@ -15,15 +15,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gtk, Gio, GdkPixbuf, GLib, Gdk
+from gi.repository import Gtk, Gio, GLib, Gdk
 from gettext import ngettext
+import bisect, hashlib
 
 from .data_model import DWEDataModel
+from .folder_importer import DWEFolderImporter
+from .folder_watcher import DWEFolderWatcher
+from .path_checker import DWEPathChecker
+from .thumbnail_loader import DWETask, QUEUE_DOCUMENT
+from .xml_loader import DWEXMLLoader
+from .picture_info import DWEResolutionChecker
 from .view import DWERowsView
 from .view import DWEThumbnailsView
 from .misc import add_pic_dialog_filters
 from .misc import add_xml_dialog_filters
 from .misc import time_to_string
+from .misc import get_natural_sort_key
 
 UI_PATH = '/com/github/maoschanz/DynamicWallpaperEditor/ui/'
 
@@ -59,6 +67,9 @@ class DWEWindow(Gtk.ApplicationWindow):
 	fix_24_btn = Gtk.Template.Child()
 	notification_label = Gtk.Template.Child()
 	status_bar = Gtk.Template.Child()
+	progress_spinner = Gtk.Template.Child()
+	stop_btn = Gtk.Template.Child()
+	zoom_scale = Gtk.Template.Child()
 
 	def __init__(self, **kwargs):
 		super().__init__(**kwargs)
@@ -66,19 +77,42 @@ class DWEWindow(Gtk.ApplicationWindow):
 		self.gio_file = None
 		self.check_24 = False # XXX still needed???? the action should be enough
 		self.update_time_lock = False
-		self._data_model = DWEDataModel(self)
-		self._is_saved = True # FIXME moche + mal implémenté
+		self._data_model = DWEDataModel()
+		self._data_model.add_observer(self.on_model_changed)
+		self.resolution_checker = DWEResolutionChecker( \
+		           self.app.picture_info_service, self.on_picture_infos_changed)
+		self.path_checker = DWEPathChecker(self.app.thumbnail_loader, \
+		         self.on_path_statuses_changed, self.app.runs_in_sandbox)
+		# What has been written in which file, to know if there is anything
+		# to save
+		self._saved_generation = self._data_model.get_generation()
+		self._saved_gfile = None
+		self._saved_digest = None
+		self._is_saving = False
+		self._save_again = False
+		self._is_destroyed = False
+		self._folder_importer = None
+		self._folder_watcher = None
+		self._xml_loader = None
+		self._import_order = None
+		self._progress_message = None
 
 		# Used in the "add pictures" file chooser dialog
 		self.preview_picture = Gtk.Image(margin_right=5)
+		self._preview_request = None
 
 		# Connect signals
 		self.connect('delete-event', self.action_close)
+		self.connect('destroy', self.on_destroy)
 		self.trans_time_btn.connect('value-changed', self.on_time_change)
 		self.static_time_btn.connect('value-changed', self.on_time_change)
 		self.info_bar.connect('close', self.close_notification)
 		self.info_bar.connect('response', self.close_notification)
 		self.search_entry.connect('search-changed', self.search_pics_in_view)
+		zoom_adjustment = self.zoom_scale.get_adjustment()
+		self._settings.bind('grid-zoom', zoom_adjustment, 'value', \
+		                                         Gio.SettingsBindFlags.DEFAULT)
+		zoom_adjustment.connect('value-changed', self.on_zoom_changed)
 
 		# Build the UI
 		self.view = None
@@ -87,6 +121,13 @@ class DWEWindow(Gtk.ApplicationWindow):
 		self.build_all_actions()
 		self.action_find_hide()
 		self.rebuild_view()
+		self.set_history_budget()
+		self._settings_handlers = [
+			self._settings.connect('changed::history-max-entries', \
+			                                         self.set_history_budget),
+			self._settings.connect('changed::history-max-size', \
+			                                         self.set_history_budget),
+		]
 		self.update_status()
 		self.close_notification()
 
@@ -104,7 +145,30 @@ class DWEWindow(Gtk.ApplicationWindow):
 			self.view = DWERowsView(self)
 		else:
 			self.view = DWEThumbnailsView(self)
-		self._data_model.update_view()
+			self.view.set_zoom(self.zoom_scale.get_value())
+		self.zoom_scale.set_visible(display_mode != 'list')
+		self.update_daylight_timings()
+		self._data_model.refresh_observers()
+
+	def on_zoom_changed(self, *args):
+		if self.view is not None:
+			self.view.set_zoom(self.zoom_scale.get_value())
+
+	def on_model_changed(self, delta):
+		self.update_history_actions()
+		for message in delta.warnings:
+			self.show_notification(message)
+		self.resolution_checker.update(delta, self._data_model)
+		self.path_checker.update(delta, self._data_model)
+		self.view.update(delta)
+
+	def on_picture_infos_changed(self, pic_ids):
+		self.view.update_picture_infos(pic_ids)
+		self.update_status()
+
+	def on_path_statuses_changed(self, pic_ids):
+		self.view.update_path_statuses(pic_ids)
+		self.update_status()
 
 	def build_time_popover(self):
 		builder = Gtk.Builder().new_from_resource(UI_PATH + 'start_time.ui')
@@ -115,6 +179,9 @@ class DWEWindow(Gtk.ApplicationWindow):
 		self.hour_spinbtn = builder.get_object('hour_spinbtn')
 		self.minute_spinbtn = builder.get_object('minute_spinbtn')
 		self.second_spinbtn = builder.get_object('second_spinbtn')
+		for spinbtn in (self.hour_spinbtn, self.minute_spinbtn, \
+		                                                   self.second_spinbtn):
+			spinbtn.connect('value-changed', self.update_daylight_timings)
 		self.start_btn.set_popover(start_time_popover)
 
 	def build_menus(self):
@@ -157,6 +224,9 @@ class DWEWindow(Gtk.ApplicationWindow):
 
 		self.add_action_simple('add', self.action_add, ['<Ctrl>a'])
 		self.add_action_simple('add_folder', self.action_add_folder, ['<Ctrl><Shift>a'])
+		self.add_action_simple('stop_loading', self.action_stop_loading, None)
+		self.add_action_simple('unlink_folder', self.action_unlink_folder, None)
+		self.set_action_sensitive('unlink_folder', False)
 
 		self.add_action_simple('find', self.action_find_show, ['<Ctrl>f'])
 		self.add_action_simple('find_close', self.action_find_hide, None)
@@ -166,7 +236,7 @@ class DWEWindow(Gtk.ApplicationWindow):
 
 		self.add_action_simple('undo', self.action_undo, ['<Ctrl>z'])
 		self.add_action_simple('redo', self.action_redo, ['<Ctrl><Shift>z'])
-		self._data_model.update_history_actions()
+		self.update_history_actions()
 
 		self.add_action_simple('pic_delete', self.action_pic_delete, ['Delete'])
 		self.add_action_simple('pic_replace', self.action_pic_replace, None)
@@ -196,12 +266,23 @@ class DWEWindow(Gtk.ApplicationWindow):
 	############################################################################
 	# History ##################################################################
 
+	def update_history_actions(self):
+		self.set_action_sensitive('undo', self._data_model.can_undo())
+		self.set_action_sensitive('redo', self._data_model.can_redo())
+
 	def action_undo(self, *args):
+		# Pictures imported after the undo would be a new history entry
+		self._stop_folder_import()
 		self._data_model.undo()
 
 	def action_redo(self, *args):
 		self._data_model.redo()
 
+	def set_history_budget(self, *args):
+		max_entries = self._settings.get_int('history-max-entries')
+		max_size = self._settings.get_int('history-max-size')
+		self._data_model.set_history_budget(max_entries, max_size)
+
 	############################################################################
 	# Window size ##############################################################
 
@@ -222,10 +303,11 @@ class DWEWindow(Gtk.ApplicationWindow):
 		self.set_type_slideshow(self.is_slideshow() and not is_daylight)
 
 	def is_slideshow(self):
-		same, st, tr = self.view.all_have_same_time()
-		self.static_time_btn.set_value(st)
-		self.trans_time_btn.set_value(tr)
-		return same
+		pictures = self._data_model.get_pictures()
+		if len(pictures) > 0:
+			self.static_time_btn.set_value(pictures[0].static)
+			self.trans_time_btn.set_value(pictures[0].transition)
+		return self._data_model.has_same_durations()
 
 	def update_type_slideshow(self, *args):
 		is_now_slideshow = not args[0].get_state()
@@ -247,6 +329,7 @@ class DWEWindow(Gtk.ApplicationWindow):
 	def set_type_daylight(self, is_now_daylight):
 		gvb = GLib.Variant.new_boolean(is_now_daylight)
 		self.lookup_action('total_24').set_state(gvb)
+		self.update_daylight_timings()
 		self.set_action_sensitive('use_durations', is_now_daylight)
 		self.set_check_24(is_now_daylight)
 		if is_now_daylight:
@@ -306,17 +389,12 @@ class DWEWindow(Gtk.ApplicationWindow):
 		self.update_status()
 
 	def get_total_time(self):
-		total_time = 0
 		if self.get_action_boolean_state('same_duration'):
-			for index in range(0, self.view._length):
-				total_time += self.static_time_btn.get_value()
-				total_time += self.trans_time_btn.get_value()
+			total_time = self.static_time_btn.get_value()
+			total_time += self.trans_time_btn.get_value()
+			total_time *= self.view._length
 		else:
-			total_time = self.view.get_view_total_time()
-
-			if self.get_action_boolean_state('total_24'):
-				temp_time = self.get_start_time()
-				self.view.update_daylight_timings(temp_time)
+			total_time = self._data_model.get_total_time()
 		return int(total_time)
 
 	def get_start_time(self):
@@ -325,6 +403,14 @@ class DWEWindow(Gtk.ApplicationWindow):
 		s = self.second_spinbtn.get_value_as_int()
 		return [h, m, s]
 
+	def update_daylight_timings(self, *args):
+		"""Show when each picture starts and ends, if the wallpaper lasts
+		24 hours. The view updates them itself when durations change."""
+		if self.get_action_boolean_state('total_24'):
+			self.view.update_daylight_timings(self.get_start_time())
+		else:
+			self.view.update_daylight_timings(None)
+
 	def update_status(self, *args):
 		"""Update the total time in the statusbar."""
 		self.status_bar.pop(0)
@@ -336,6 +422,17 @@ class DWEWindow(Gtk.ApplicationWindow):
 		# XXX ça prend en compte le 0 comme un pluriel cette merde ^
 		if total_time >= 60:
 			message += ' = ' + time_to_string(total_time)
+		if self._folder_watcher is not None:
+			message += ' - ' + _("In sync with %s") % \
+			                                     self._folder_watcher.get_name()
+		nb_missing = self.path_checker.get_nb_missing()
+		if nb_missing > 0:
+			message += ' - ' + ngettext("%s picture is missing", \
+			                     "%s pictures are missing", nb_missing) % nb_missing
+		nb_mismatched = self.resolution_checker.get_nb_mismatched()
+		if nb_mismatched > 0:
+			message += ' - ' + ngettext("%s picture has an unusual size", \
+			       "%s pictures have an unusual size", nb_mismatched) % nb_mismatched
 		if self.check_24:
 			if total_time != 86400:
 				self.show_notification(_("The total duration isn't 24 hours."))
@@ -343,6 +440,9 @@ class DWEWindow(Gtk.ApplicationWindow):
 			else:
 				self.close_notification()
 		self.status_bar.push(0, message)
+		if self._progress_message is not None:
+			self.status_bar.remove_all(1)
+			self.status_bar.push(1, self._progress_message)
 		return total_time
 
 	def on_time_change(self, *args):
@@ -362,10 +462,30 @@ class DWEWindow(Gtk.ApplicationWindow):
 		self.info_bar.set_visible(True)
 
 	def action_close(self, *args):
-		return not self.confirm_save_modifs()
+		if not self.confirm_save_modifs():
+			return True
+		self.action_stop_loading()
+		self.action_unlink_folder()
+		self.resolution_checker.clear()
+		self.path_checker.clear()
+		return False
+
+	def on_destroy(self, *args):
+		# A save may still be running
+		self._is_destroyed = True
+		# The settings are shared by all windows
+		for handler_id in self._settings_handlers:
+			self._settings.disconnect(handler_id)
+
+	def is_saved(self):
+		return self._data_model.get_generation() == self._saved_generation
 
 	def confirm_save_modifs(self):
-		if self._is_saved:
+		if self.is_saved():
+			return True
+		if self._xml_loader is not None:
+			# Nothing can be saved before the file is entirely loaded, and the
+			# callers cancel the loading
 			return True
 
 		if self.gio_file is None:
@@ -414,7 +534,7 @@ class DWEWindow(Gtk.ApplicationWindow):
 	def action_pic_replace(self, *args):
 		pic = self.view.get_active_pic()
 		self.status_bar.push(1, _("Loading…"))
-		title = _("Replace %s") % pic.filename
+		title = _("Replace %s") % pic.path
 		file_chooser = self._get_add_pic_dialog(title, False)
 		response = file_chooser.run()
 		if response == Gtk.ResponseType.OK:
@@ -428,12 +548,12 @@ class DWEWindow(Gtk.ApplicationWindow):
 		file_chooser.destroy()
 
 	def action_pic_open(self, *args):
-		uri = 'file://' + self.view.get_active_pic().filename
+		uri = 'file://' + self.view.get_active_pic().path
 		Gtk.show_uri(None, uri, Gdk.CURRENT_TIME)
 
 	def action_pic_directory(self, *args):
-		trunc = -1 * len(self.view.get_active_pic().filename.split('/')[-1])
-		uri = 'file://' + self.view.get_active_pic().filename
+		trunc = -1 * len(self.view.get_active_pic().path.split('/')[-1])
+		uri = 'file://' + self.view.get_active_pic().path
 		Gtk.show_uri(None, uri[0:trunc], Gdk.CURRENT_TIME)
 
 	def action_pic_first(self, *args):
@@ -472,32 +592,182 @@ class DWEWindow(Gtk.ApplicationWindow):
 	# Adding pictures to the view ##############################################
 
 	def action_add_folder(self, *args):
-		"""Run an "open" dialog and create a list of DWEPictureRow from the
-		result. The actual paths are needed in XML files, so it can't be a
-		'native dialog' (system's portal)."""
-		self.status_bar.push(1, _("Loading…"))
+		"""Run an "open" dialog and add the pictures of the chosen folder. The
+		actual paths are needed in XML files, so it can't be a 'native dialog'
+		(system's portal)."""
 		file_chooser = Gtk.FileChooserDialog(_("Add a folder"), self,
 		               Gtk.FileChooserAction.SELECT_FOLDER,
 		               (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
 		               Gtk.STOCK_OPEN, Gtk.ResponseType.OK),
 		               select_multiple=False)
+		options_widget, link_btn = self._get_import_options_widget()
+		file_chooser.set_extra_widget(options_widget)
 
 		response = file_chooser.run()
-		if response == Gtk.ResponseType.OK:
-			self.update_time_lock = True
-			enumerator = file_chooser.get_file().enumerate_children('standard::*', \
-			             Gio.FileQueryInfoFlags.NONE, None)
-			f = enumerator.next_file(None)
-			array = []
-			while f is not None:
-				if 'image/' in f.get_content_type():
-					array.append(file_chooser.get_filename() + '/' + f.get_display_name())
-				f = enumerator.next_file(None)
-			self._add_pictures_from_untimed_list(array)
-			self.update_time_lock = False
-			self.on_time_change()
-		self.status_bar.pop(1)
+		gfile = file_chooser.get_file()
+		is_linked = link_btn.get_active()
 		file_chooser.destroy()
+		if response == Gtk.ResponseType.OK:
+			self.import_folder(gfile, is_linked)
+
+	def _get_import_options_widget(self):
+		"""The options are bound to their settings, so they are remembered
+		for the next import."""
+		grid = Gtk.Grid(column_spacing=12, row_spacing=6, visible=True)
+		flags = Gio.SettingsBindFlags.DEFAULT
+		recursive_btn = Gtk.CheckButton(label=_("Include subfolders"), \
+		                                                            visible=True)
+		self._settings.bind('import-recursive', recursive_btn, 'active', flags)
+		grid.attach(recursive_btn, 0, 0, 1, 1)
+		sort_btn = Gtk.CheckButton(label=_("Sort by name"), visible=True)
+		self._settings.bind('import-sorted', sort_btn, 'active', flags)
+		grid.attach(sort_btn, 1, 0, 1, 1)
+		include_entry = Gtk.Entry(placeholder_text=_("Only these names"), \
+		               tooltip_text=_("Patterns separated by spaces, for " + \
+		                             "example: *.jpg *.png"), visible=True)
+		self._settings.bind('import-include', include_entry, 'text', flags)
+		grid.attach(include_entry, 0, 1, 1, 1)
+		exclude_entry = Gtk.Entry(placeholder_text=_("Ignored names"), \
+		               tooltip_text=_("Patterns separated by spaces, for " + \
+		                              "example: *_small.jpg raw"), visible=True)
+		self._settings.bind('import-exclude', exclude_entry, 'text', flags)
+		grid.attach(exclude_entry, 1, 1, 1, 1)
+		# Not a setting: most folders don't change
+		link_btn = Gtk.CheckButton(label=_("Keep in sync with this folder"), \
+		                   tooltip_text=_("Pictures added to the folder " + \
+		                   "later will be added to the wallpaper"), visible=True)
+		grid.attach(link_btn, 0, 2, 2, 1)
+		return grid, link_btn
+
+	def import_folder(self, gfile, is_linked=False):
+		"""The folder is read in the background, and its pictures are added
+		batch after batch, as a single entry of the history. If `is_linked`,
+		the changes of the folder will then be applied to the wallpaper."""
+		self._stop_folder_import()
+		include = self._settings.get_string('import-include').split()
+		exclude = self._settings.get_string('import-exclude').split()
+		# The callbacks of a replaced importer are ignored
+		importer = DWEFolderImporter(gfile, \
+		           lambda paths: self._on_folder_pictures(importer, paths), \
+		           lambda error: self._on_folder_imported(importer, error), \
+		           self._settings.get_boolean('import-recursive'), \
+		           include, exclude)
+		self._folder_importer = importer
+		if is_linked:
+			self.link_folder(gfile, include, exclude)
+		if self._settings.get_boolean('import-sorted'):
+			# Keys and ids of the imported pictures, sorted by path
+			self._import_order = ([], [])
+			self._import_anchor = self._data_model.get_last_id()
+		else:
+			self._import_order = None
+		self.show_progress(_("Importing pictures…"))
+		importer.start()
+
+	def _on_folder_pictures(self, importer, paths):
+		if importer is not self._folder_importer:
+			return
+		self.update_time_lock = True
+		if self._import_order is None:
+			self._add_pictures_from_untimed_list(paths, importer)
+		else:
+			self._insert_sorted_pictures(paths, importer)
+		self.update_time_lock = False
+		self.on_time_change()
+		self.show_progress(_("Importing pictures… (%s found)") % \
+		                                                      importer.nb_found)
+
+	def _insert_sorted_pictures(self, paths, group):
+		"""Add the pictures at their place among the pictures already imported,
+		so the import is in natural order even if the folders are read in
+		parallel."""
+		keys, ids = self._import_order
+		data_model = self._data_model
+		with data_model.transaction(group):
+			for path in sorted(paths, key=get_natural_sort_key):
+				key = get_natural_sort_key(path)
+				position = bisect.bisect(keys, key)
+				after = self._import_anchor
+				if after is not None and not data_model.has_picture(after):
+					after = None
+				# The user may have deleted imported pictures in the meantime
+				for i in range(position - 1, -1, -1):
+					if data_model.has_picture(ids[i]):
+						after = ids[i]
+						break
+				operation = {
+					'type': 'add',
+					'path': path,
+					'static': 10,
+					'transition': 0,
+					'after': after,
+				}
+				data_model.do_operation(operation)
+				keys.insert(position, key)
+				ids.insert(position, operation['pic_id'])
+
+	def _on_folder_imported(self, importer, error):
+		if importer is not self._folder_importer:
+			return
+		self._folder_importer = None
+		self._import_order = None
+		self._progress_message = None
+		self.hide_progress()
+		if error is not None:
+			self.show_notification(_("Error opening this folder.") + \
+			                                               "\n" + str(error))
+
+	def link_folder(self, gfile, include, exclude):
+		self.action_unlink_folder()
+		try:
+			self._folder_watcher = DWEFolderWatcher(gfile, self._data_model, \
+			                      include, exclude, self._on_linked_folder_synced)
+		except Exception as err:
+			self.show_notification(str(err))
+			return
+		self._data_model.set_xml_cache_enabled(True)
+		self.set_action_sensitive('unlink_folder', True)
+		self.update_status()
+
+	def _on_linked_folder_synced(self):
+		# The file is saved from the model, the folder isn't read again
+		if self.gio_file is not None:
+			self.action_save()
+
+	def action_unlink_folder(self, *args):
+		if self._folder_watcher is None:
+			return
+		self._folder_watcher.stop()
+		self._folder_watcher = None
+		self._data_model.set_xml_cache_enabled(False)
+		self.set_action_sensitive('unlink_folder', False)
+		self.update_status()
+
+	def action_stop_loading(self, *args):
+		self._stop_folder_import()
+		if self._xml_loader is not None:
+			self._xml_loader.cancel()
+
+	def _stop_folder_import(self):
+		if self._folder_importer is not None:
+			self._folder_importer.cancel()
+
+	def show_progress(self, message):
+		"""The message stays above the total time in the status bar, until
+		`hide_progress` is called."""
+		self._progress_message = message
+		self.status_bar.remove_all(1)
+		self.status_bar.push(1, message)
+		self.progress_spinner.set_visible(True)
+		self.progress_spinner.start()
+		self.stop_btn.set_visible(True)
+
+	def hide_progress(self):
+		self._progress_message = None
+		self.status_bar.remove_all(1)
+		self.progress_spinner.stop()
+		self.progress_spinner.set_visible(False)
+		self.stop_btn.set_visible(False)
 
 	def action_add(self, *args):
 		"""Run an "open" dialog and create a list of DWEPictureRow from the result.
@@ -515,19 +785,15 @@ class DWEWindow(Gtk.ApplicationWindow):
 		self.status_bar.pop(1)
 		file_chooser.destroy()
 
-	def _add_pictures_from_untimed_list(self, pictures_array):
-		operation = {
-			'type': 'multi',
-			'list': [],
-		}
-		for pic_path in pictures_array:
-			operation['list'].append({
-				'type': 'add',
-				'path': pic_path,
-				'static': 10,
-				'transition': 0
-			})
-		self._data_model.do_operation(operation)
+	def _add_pictures_from_untimed_list(self, pictures_array, group=None):
+		with self._data_model.transaction(group):
+			for pic_path in pictures_array:
+				self._data_model.do_operation({
+					'type': 'add',
+					'path': pic_path,
+					'static': 10,
+					'transition': 0
+				})
 
 	def _get_add_pic_dialog(self, title, allow_multiple):
 		file_chooser = Gtk.FileChooserDialog(title, self,
@@ -539,17 +805,39 @@ class DWEWindow(Gtk.ApplicationWindow):
 			use_preview_label=False)
 		add_pic_dialog_filters(file_chooser)
 		file_chooser.connect('update-preview', self._cb_update_preview)
+		file_chooser.connect('destroy', self._cancel_preview)
 		return file_chooser
 
 	def _cb_update_preview(self, fc):
-		if fc.get_preview_file() is None:
+		"""Decode the preview in the background, using the same caches as the
+		thumbnails of the pictures. The previous request is cancelled, so
+		moving quickly through a folder of big pictures doesn't pile up
+		useless decoding."""
+		self._cancel_preview()
+		path = fc.get_preview_filename()
+		if path is None:
+			fc.set_preview_widget_active(False)
 			return
-		if fc.get_preview_file().query_file_type(Gio.FileQueryInfoFlags.NONE) is not Gio.FileType.REGULAR:
+		scale = self.preview_picture.get_scale_factor()
+		size = 200 * scale
+		self._preview_request = self.app.thumbnail_loader.request(path, size, \
+		             size, lambda pixbuf, error: self._on_preview_loaded(fc, \
+		                                                   pixbuf, scale))
+
+	def _on_preview_loaded(self, fc, pixbuf, scale):
+		self._preview_request = None
+		if pixbuf is None:
+			# It's a folder, or it can't be read
 			fc.set_preview_widget_active(False)
 			return
+		surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, scale, None)
+		self.preview_picture.set_from_surface(surface)
 		fc.set_preview_widget_active(True)
-		pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(fc.get_filename(), 200, 200, True)
-		self.preview_picture.set_from_pixbuf(pixbuf)
+
+	def _cancel_preview(self, *args):
+		if self._preview_request is not None:
+			self._preview_request.cancel()
+			self._preview_request = None
 
 	############################################################################
 	# Opening an XML file ######################################################
@@ -557,61 +845,167 @@ class DWEWindow(Gtk.ApplicationWindow):
 	def action_open(self, *args):
 		if not self.confirm_save_modifs():
 			return
-		self.status_bar.push(1, _("Loading…"))
 		file_chooser = Gtk.FileChooserNative.new(_("Open"), self, \
 		                     Gtk.FileChooserAction.OPEN, _("Open"), _("Cancel"))
 		add_xml_dialog_filters(file_chooser)
 		response = file_chooser.run()
 		if response == Gtk.ResponseType.ACCEPT:
-			self.update_time_lock = True
 			self.load_gfile(file_chooser.get_file())
-			self.update_time_lock = False
-			self.on_time_change()
 		file_chooser.destroy()
-		self.status_bar.pop(1)
 
 	def load_gfile(self, gfile):
+		"""Read and parse the XML file in the background. The pictures appear
+		in the view as soon as they're parsed, and the window stays usable."""
+		self.action_stop_loading()
+		self.action_unlink_folder()
 		self.gio_file = gfile
-		try:
-			self.load_list_from_xml()
-			self.update_win_title(self.gio_file.get_path().split('/')[-1])
-			# self.auto_detect_type() # FIXME FIXME FIXME
-			self.set_action_sensitive('set_wp', True)
-		except Exception as err:
-			self.show_notification(str(err))
+		self.set_action_sensitive('set_wp', False)
+		# Saving now would replace the file with the pictures parsed so far
+		self.set_action_sensitive('save', False)
+		self.set_action_sensitive('save_as', False)
+		self._xml_loader = DWEXMLLoader(gfile, self._data_model, \
+		      self.app.thumbnail_loader, self._on_xml_progress, self._on_xml_loaded)
+		self.show_progress(_("Opening…"))
+		self._xml_loader.start()
+
+	def _on_xml_progress(self):
+		nb_pictures = len(self._data_model.get_pictures())
+		self.show_progress(_("Opening… (%s pictures)") % nb_pictures)
+
+	def _on_xml_loaded(self, loader, error):
+		if loader is not self._xml_loader:
+			return # a previous file, whose loading has been cancelled
+		is_cancelled = loader.is_cancelled()
+		self._xml_loader = None
+		self.hide_progress()
+		self.set_action_sensitive('save', True)
+		self.set_action_sensitive('save_as', True)
+		if error is not None or is_cancelled:
+			if error is not None:
+				self.show_notification(str(error))
+			# The model is empty again, there is nothing to save
 			self.gio_file = None
-
-	def load_list_from_xml(self):
-		"""This method parses the XML from `self.gio_file`, looking for the
-		pictures' paths and durations."""
-		try:
-			f = open(self.gio_file.get_path(), 'r')
-			xml_text = f.read()
-			f.close()
-		except Exception as err:
-			raise Exception(_("This dynamic wallpaper is corrupted"))
-			# So corrupted it can't even be read as a text file
-		self._data_model.load_from_xml(xml_text)
+			self._saved_generation = self._data_model.get_generation()
+			self._saved_gfile = None
+			self._saved_digest = None
+			return
+		self.update_win_title(self.gio_file.get_path().split('/')[-1])
+		# self.auto_detect_type() # FIXME FIXME FIXME
+		self.set_action_sensitive('set_wp', True)
+		# The file isn't exactly what an export would write, so its digest
+		# is unknown, but the data is the data of the file, unless the user
+		# edited it while it was loading
+		self._saved_generation = self._data_model.get_generation()
+		if self._data_model.is_edited_while_loading():
+			self._saved_generation = None
+		self._saved_gfile = self.gio_file
+		self._saved_digest = None
+		self.on_time_change()
 
 	############################################################################
 	# Saving ###################################################################
 
 	def action_save(self, *args):
-		"""Write the result of `DWEDataModel.export_to_xml` in a file."""
+		"""Write the result of `DWEDataModel.export_to_xml` in a file. The XML
+		is generated from a snapshot of the data, and streamed to the file on
+		a worker thread, chunk by chunk, so the whole document is never in
+		memory. Nothing is done if the data didn't change since the last save,
+		and the file isn't replaced if the generated XML is exactly what it
+		already contains (after an undo for example)."""
+		if self._xml_loader is not None:
+			return # the file isn't entirely loaded
 		if self.gio_file is None:
 			is_saved = self.run_save_file_chooser()
 			if not is_saved:
 				return
-		contents = self._data_model.export_to_xml().encode('utf-8')
-		self.gio_file.replace_contents(contents, None, False, \
-		                                         Gio.FileCreateFlags.NONE, None)
-		self._is_saved = True
+		if self.is_saved() and self._saved_gfile is not None \
+		                                  and self.gio_file.equal(self._saved_gfile):
+			return
+		if self._is_saving:
+			self._save_again = True
+			return
+		self._is_saving = True
+		generation = self._data_model.get_generation()
+		gfile = self.gio_file
+		snapshot = self._data_model.get_export_snapshot()
+		previous_digest = None
+		if self._saved_gfile is not None and gfile.equal(self._saved_gfile):
+			previous_digest = self._saved_digest
+		task = DWETask(lambda digest, error: self._on_file_saved(gfile, \
+		                               generation, snapshot, digest, error))
+		# Until the file is written, the application shouldn't quit, even if
+		# this window is closed
+		self.app.hold()
+		self.app.thumbnail_loader.run_in_worker(task, lambda task: \
+		             self._write_snapshot(gfile, snapshot, previous_digest, \
+		                                               task), QUEUE_DOCUMENT)
+
+	def _write_snapshot(self, gfile, snapshot, previous_digest, task):
+		# Called on a worker thread. The contents are written in a temporary
+		# file which then replaces the previous version when the stream is
+		# closed, so a failure doesn't destroy it.
+		stream = gfile.replace(None, False, Gio.FileCreateFlags.NONE, \
+		                                                       task.cancellable)
+		chunks = self._data_model.export_snapshot_to_xml_chunks(snapshot)
+		digest = hashlib.sha256()
+		try:
+			for chunk in chunks:
+				data = chunk.encode('utf-8')
+				digest.update(data)
+				stream.write_all(data, task.cancellable)
+		except Exception:
+			self._discard_stream(stream)
+			raise
+		digest = digest.hexdigest()
+		if digest == previous_digest:
+			# Different operations, but the same XML: the file is kept
+			self._discard_stream(stream)
+		else:
+			stream.close(task.cancellable)
+		return digest
+
+	def _discard_stream(self, stream):
+		# Closing the stream with a cancelled cancellable removes the temporary
+		# file, and keeps the previous version
+		cancellable = Gio.Cancellable()
+		cancellable.cancel()
+		try:
+			stream.close(cancellable)
+		except GLib.Error:
+			pass
+
+	def _on_file_saved(self, gfile, generation, snapshot, digest, error):
+		if error is not None:
+			self._end_save(error)
+			return
+		self._data_model.end_export(snapshot)
+		self._saved_generation = generation
+		self._saved_gfile = gfile
+		self._saved_digest = digest
+		self._end_save(None)
+
+	def _end_save(self, error):
+		self._is_saving = False
+		self.app.release()
+		if self._is_destroyed:
+			if error is not None:
+				print(_("The file can't be saved") + "\n" + str(error))
+			return
+		if error is not None:
+			self._save_again = False
+			self.show_notification(str(error))
+			return
 		self.set_action_sensitive('set_wp', True)
+		if self._save_again:
+			self._save_again = False
+			self.action_save()
 
 	def update_win_title(self, file_name):
 		self.set_title(file_name)
 
 	def action_save_as(self, *args):
+		if self._xml_loader is not None:
+			return # the file isn't entirely loaded
 		is_saved = self.run_save_file_chooser()
 		if is_saved == True:
 			self.action_save()
@@ -0,0 +1,127 @@
+# xml_loader.py
+#
+# Copyright 2018-2021 Romain F. T.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+from gi.repository import Gio, GLib
+
+from .data_model import DWEDataModel, DWEXMLParser
+from .thumbnail_loader import DWETask, QUEUE_DOCUMENT
+
+class DWEXMLLoader():
+	"""Load an XML file into a data model without blocking the main loop: the
+	file is read with the asynchronous API of Gio, and each chunk is parsed
+	on the document thread of the thumbnail loader, so it doesn't wait behind
+	the probing of pictures. This thread is a single one, so the chunks are
+	parsed in order. The items of each chunk are added to the model as soon
+	as they're parsed, so the view is filled progressively. `on_done` is
+	called once, with the loader and the error (or None)."""
+
+	def __init__(self, gfile, data_model, loader, on_progress, on_done):
+		self._gfile = gfile
+		self._data_model = data_model
+		self._loader = loader
+		self._on_progress = on_progress
+		self._on_done = on_done
+		self._cancellable = Gio.Cancellable()
+		self._parser = DWEXMLParser()
+		self._tasks = deque() # chunks being parsed
+		self._is_read = False
+		self.nb_bytes = 0
+
+	def start(self):
+		self._data_model.begin_loading()
+		self._gfile.read_async(GLib.PRIORITY_DEFAULT, self._cancellable, \
+		                                              self._on_stream_ready, None)
+
+	def cancel(self):
+		if self._cancellable.is_cancelled():
+			return
+		self._cancellable.cancel()
+		for task in self._tasks:
+			task.cancel()
+		self._tasks.clear()
+		self._data_model.abort_loading()
+		self._on_done(self, None)
+
+	def is_cancelled(self):
+		return self._cancellable.is_cancelled()
+
+	############################################################################
+	# Reading ##################################################################
+
+	def _on_stream_ready(self, gfile, result, *args):
+		try:
+			stream = gfile.read_finish(result)
+		except GLib.Error as err:
+			self._fail(err)
+			return
+		self._read_next_chunk(stream)
+
+	def _read_next_chunk(self, stream):
+		stream.read_bytes_async(DWEDataModel.XML_CHUNK_SIZE, \
+		                    GLib.PRIORITY_DEFAULT, self._cancellable, \
+		                    self._on_chunk_read, None)
+
+	def _on_chunk_read(self, stream, result, *args):
+		try:
+			chunk = stream.read_bytes_finish(result).get_data()
+		except GLib.Error as err:
+			stream.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+			self._fail(err)
+			return
+		if len(chunk) == 0:
+			stream.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+			self._is_read = True
+			self._parse(lambda task: self._parser.close())
+			return
+		self.nb_bytes += len(chunk)
+		self._parse(lambda task: self._parser.feed(chunk))
+		self._read_next_chunk(stream)
+
+	############################################################################
+	# Parsing ##################################################################
+
+	def _parse(self, function):
+		task = DWETask(self._on_parsed)
+		self._tasks.append(task)
+		self._loader.run_in_worker(task, function, QUEUE_DOCUMENT)
+
+	def _on_parsed(self, items, error):
+		self._tasks.popleft()
+		if error is not None:
+			self._fail(error)
+			return
+		self._data_model.load_xml_items(items)
+		if self._is_read and len(self._tasks) == 0:
+			self._data_model.end_loading()
+			self._on_done(self, None)
+		else:
+			self._on_progress()
+
+	def _fail(self, error):
+		if self._cancellable.is_cancelled():
+			return # the failure is a consequence of the cancellation
+		self._cancellable.cancel()
+		for task in self._tasks:
+			task.cancel()
+		self._tasks.clear()
+		self._data_model.abort_loading()
+		self._on_done(self, error)
+
+	############################################################################
+################################################################################
+